@@ -3,9 +3,14 @@ import numpy as np
 import _pickle as cPickle
 import os
 import gzip
+import hashlib
 import math
 import sys
 import time
+import copy
+import threading
+import socket
+import struct
 from matplotlib import pyplot as plt
 
 # Loading data from MNIST
@@ -63,6 +68,63 @@ def tanh(x):
 def tanh_d(x):
     return 1-((tanh(x))**2)
 
+# fast approximations of sigmoid and tanh
+# the maximum absolute errors given below are with respect to the exact
+# sigmoid() and tanh() over the whole real line
+
+# hard sigmoid: tangent at 0 clipped to [0, 1], max error 0.1192 at |x| = 2
+def hard_sigmoid(x):
+    return np.clip(0.25*x + 0.5, 0.0, 1.0)
+
+def hard_sigmoid_d(x):
+    return 0.25 * (np.abs(x) < 2)
+
+# hard tanh: identity clipped to [-1, 1], max error 0.2384 at |x| = 1
+def hard_tanh(x):
+    return np.clip(x, -1.0, 1.0)
+
+def hard_tanh_d(x):
+    return 1.0 * (np.abs(x) < 1)
+
+class InterpolatedTable(object):
+    """ Table lookup with linear interpolation of a function f sampled
+        at n+1 equidistant points of [lo, hi]. Outside the range the
+        values at the boundaries are used. The error is at most
+        max(h^2/8 * max|f''|, |f(+-inf) - f(hi or lo)|) with h = (hi-lo)/n.
+    """
+    def __init__(self, f, lo, hi, n):
+        self.lo = lo
+        self.n = n
+        self.inv_h = n / float(hi - lo)
+        table = f(np.linspace(lo, hi, n+1))
+        self.table = table[:-1]
+        self.slope = np.diff(table)
+
+    def __call__(self, x):
+        # float64 position in units of the table spacing (in float32 the
+        # upper clip bound would round up to n), works for scalars too
+        x = np.asarray(x, dtype=np.float64)
+        u = np.clip((x - self.lo) * self.inv_h, 0, self.n - 1e-6)
+        # NaN gets index 0 and propagates through u - i
+        i = np.where(np.isnan(u), 0, u).astype(np.intp)
+        return self.table[i] + (u - i) * self.slope[i]
+
+# the tables are only compared in benchmark_activations(): in numpy the
+# gather and interpolation are slower than np.exp / np.tanh, so they are
+# not offered as Activation modes
+# h = 1/128, max|sigmoid''| = 0.0962, 1-sigmoid(16) = 1.1e-7: max error 7.4e-7
+sigmoid_lut = InterpolatedTable(sigmoid, -16.0, 16.0, 4096)
+# h = 1/256, max|tanh''| = 0.770, 1-tanh(8) = 2.3e-7: max error 1.5e-6
+tanh_lut = InterpolatedTable(tanh, -8.0, 8.0, 4096)
+
+# derivatives written as functions of the activation output,
+# so bprop does not have to evaluate the activation again
+def sigmoid_d_out(a):
+    return a*(1-a)
+
+def tanh_d_out(a):
+    return 1-(a**2)
+
 def relu(x): #rectified linear unit
     return np.maximum(0.0,x)
 
@@ -81,13 +143,15 @@ def softmax(x, axis=1):
     e_x = np.exp(x_safe)
     return e_x / np.sum(e_x, axis=axis, keepdims=True)
 
-def one_hot(labels):
+def one_hot(labels, n_classes=None):
     """this creates a one hot encoding from a flat vector:
     i.e. given y = [0,2,1]
      it creates y_one_hot = [[1,0,0], [0,0,1], [0,1,0]]
+    n_classes fixes the width, e.g. for a subset that misses some classes
     """
     classes = np.unique(labels)
-    n_classes = classes.size
+    if n_classes is None:
+        n_classes = classes.size
     one_hot_labels = np.zeros(labels.shape + (n_classes,))
     for c in classes:
         one_hot_labels[labels == c, c] = 1
@@ -102,28 +166,42 @@ class Activation(object):
 
     def __init__(self, tname):
         self.tname = tname
+        # if set, the derivative is computed from the last output
+        # instead of the last input
+        self.act_d_out = None
         if tname == 'sigmoid':
             self.act = sigmoid
             self.act_d = sigmoid_d
+            self.act_d_out = sigmoid_d_out
         elif tname == 'tanh':
             self.act = tanh
             self.act_d = tanh_d
+            self.act_d_out = tanh_d_out
         elif tname == 'relu':
             self.act = relu
             self.act_d = relu_d
+        # fast approximations, see the error bounds above
+        elif tname == 'hard_sigmoid':
+            self.act = hard_sigmoid
+            self.act_d = hard_sigmoid_d
+        elif tname == 'hard_tanh':
+            self.act = hard_tanh
+            self.act_d = hard_tanh_d
         else:
             raise ValueError('Invalid activation function.')
 
     def fprop(self, input):
-        # we need to remember the last input
+        # we need to remember the last input (and output)
         # so that we can calculate the derivative with respect
         # to it later on
         self.z = input
         # print("Z activated")
-        return self.act(input)
+        self.a = self.act(input)
+        return self.a
 
     def bprop(self, output_grad):
-
+        if self.act_d_out is not None:
+            return output_grad * self.act_d_out(self.a)
         return output_grad * self.act_d(self.z)
 
 # define a base class for layers
@@ -172,6 +250,44 @@ class Parameterized(object):
         raise NotImplementedError('This is an interface class, please use a derived instance')
 
 
+class InputProjection(object):
+    """ Optional preprocessing stage in front of the InputLayer that reduces
+        the inputs from d to k features, either with PCA ('pca') or with a
+        sparse random projection ('random', Li et al. with density 1/sqrt(d)).
+        The projection is fitted once, see project_data() for caching it.
+    """
+    def __init__(self, method, k, seed=0):
+        if method not in ('pca', 'random'):
+            raise ValueError('Invalid projection method.')
+        self.method = method
+        self.k = k
+        self.seed = seed
+        self.mean = None
+        self.P = None
+
+    def fit(self, X):
+        d = X.shape[1]
+        if self.method == 'pca':
+            self.mean = np.mean(X, axis=0, dtype=np.float64)
+            X_centered = X - self.mean
+            cov = np.dot(X_centered.T, X_centered) / X.shape[0]
+            # eigh returns the eigenvalues in ascending order
+            eig_val, eig_vec = np.linalg.eigh(cov)
+            self.P = eig_vec[:, ::-1][:, :self.k]
+        else:
+            rng = np.random.RandomState(self.seed)
+            s = np.sqrt(d)
+            # +-sqrt(s/k) with probability 1/(2s) each, 0 otherwise
+            signs = rng.choice([-1.0, 0.0, 1.0], size=(d, self.k),
+                               p=[0.5/s, 1.0 - 1.0/s, 0.5/s])
+            self.mean = np.zeros(d)
+            self.P = np.sqrt(s / self.k) * signs
+        return self
+
+    def transform(self, X):
+        return np.dot(X - self.mean, self.P).astype(X.dtype)
+
+
 class InputLayer(Layer):
     def __init__(self,input_shape):
         if not isinstance(input_shape,tuple):
@@ -210,6 +326,10 @@ class FullyConnectedLayer(Layer,Parameterized):
         self.b = b
         self.dW = None
         self.db = None
+        # pruning mask (same shape as W, 1 = keep, 0 = pruned)
+        # and the sparse copy of W used for inference only
+        self.mask = None
+        self.W_sparse = None
 
     def output_size(self):
         return (self.input_shape[0], self.num_units)
@@ -264,6 +384,120 @@ class FullyConnectedLayer(Layer,Parameterized):
     def grad_params(self):
         return self.dW, self.db
 
+    def prune(self, sparsity):
+        """ Magnitude pruning: zero out the fraction 'sparsity' of the
+            weights with the smallest absolute value and remember them
+            in the mask. The bias is never pruned.
+        """
+        n_prune = int(sparsity * self.W.size)
+        mask = np.ones(self.W.size)
+        if n_prune > 0:
+            # already pruned weights are zero, so they are always
+            # among the smallest ones and stay pruned
+            idx = np.argpartition(np.abs(self.W).ravel(), n_prune-1)[:n_prune]
+            mask[idx] = 0
+        self.mask = mask.reshape(self.W.shape)
+        self.apply_mask()
+
+    def apply_mask(self):
+        # called after every parameter update so that pruned weights stay zero
+        if self.mask is not None:
+            self.W *= self.mask
+
+    def sparsity(self):
+        return 1.0 - np.count_nonzero(self.W) / float(self.W.size)
+
+    def sparsify(self):
+        """ Store the (pruned) weights in compressed sparse row format.
+            The transposed matrix is stored so that the product in
+            fprop_sparse() runs over the rows of W_sparse.
+        """
+        import scipy.sparse
+        self.W_sparse = scipy.sparse.csr_matrix(self.W.T)
+
+    def fprop_sparse(self, input):
+        """ Inference only forward propagation with the sparse weights.
+            Nothing is cached, so bprop cannot be called afterwards.
+        """
+        if self.W_sparse is None:
+            output = np.dot(input, self.W) + self.b
+        else:
+            output = self.W_sparse.dot(input.T).T + self.b
+        if self.activation_fun is not None:
+            output = self.activation_fun.act(output)
+        return output
+
+
+class LowRankLayer(Layer,Parameterized):
+    """ A fully connected layer whose weight matrix is factorized
+        into two thin matrices W ~ U V with U: (num_units_prev, rank)
+        and V: (rank, num_units). Use low_rank_factorize() to build
+        one from a trained FullyConnectedLayer.
+    """
+    def __init__(self, input_shape, U, V, b, activation_fun=None):
+        self.input_shape = input_shape
+        self.num_units = V.shape[1]
+        self.rank = U.shape[1]
+        self.activation_fun = activation_fun
+        self.U = U
+        self.V = V
+        self.b = b
+        self.dU = None
+        self.dV = None
+        self.db = None
+
+    def output_size(self):
+        return (self.input_shape[0], self.num_units)
+
+    def fprop(self, input):
+        # project to the rank dimensional space first, that is where
+        # the savings come from: n*(d+k)*r instead of n*d*k operations
+        self.last_input = input
+        self.last_proj = np.dot(input, self.U)
+        output = np.dot(self.last_proj, self.V) + self.b
+        if self.activation_fun is not None:
+            output = self.activation_fun.fprop(output)
+        return output
+
+    def bprop(self, output_grad):
+        if self.activation_fun is not None:
+            output_grad = self.activation_fun.bprop(output_grad)
+
+        n = output_grad.shape[0]
+        self.dV = np.dot(self.last_proj.T, output_grad)/n
+        self.db = np.mean(output_grad,axis=0)
+        proj_grad = np.dot(output_grad, self.V.T)
+        self.dU = np.dot(self.last_input.T, proj_grad)/n
+        grad_input = np.dot(proj_grad, self.U.T)
+        return grad_input
+
+    def params(self):
+        return self.U, self.V, self.b
+
+    def grad_params(self):
+        return self.dU, self.dV, self.db
+
+
+def low_rank_factorize(layer, rank=None, energy=None):
+    """ Replace a trained FullyConnectedLayer by a LowRankLayer using the
+        truncated SVD of its weights. Either a fixed 'rank' is used or the
+        smallest rank that keeps the fraction 'energy' of the sum of the
+        squared singular values.
+    """
+    if (rank is None) == (energy is None):
+        raise ValueError("Specify either rank or energy.")
+    U, s, Vt = np.linalg.svd(layer.W, full_matrices=False)
+    if rank is None:
+        cum_energy = np.cumsum(s**2) / np.sum(s**2)
+        rank = int(np.searchsorted(cum_energy, energy)) + 1
+    rank = min(rank, s.shape[0])
+    # split the singular values evenly between both factors
+    sqrt_s = np.sqrt(s[:rank])
+    U_r = U[:, :rank] * sqrt_s
+    V_r = sqrt_s[:, None] * Vt[:rank]
+    return LowRankLayer(layer.input_shape, U_r, V_r, np.copy(layer.b),
+                        layer.activation_fun)
+
 
 # finally we specify the interface for output layers
 # which are layers that also have a loss function
@@ -371,6 +605,19 @@ class NeuralNetwork:
         return Y_pred
 
 
+    def predict_sparse(self, X):
+        """ Inference only version of predict() that uses the sparse
+            weights of the fully connected layers (see sparsify()).
+        """
+        X_next = X
+        for layer in self.layers:
+            if isinstance(layer, FullyConnectedLayer):
+                X_next = layer.fprop_sparse(X_next)
+            else:
+                X_next = layer.fprop(X_next)
+        return X_next
+
+
     def backpropagate(self, Y, Y_pred, upto=0):
         """ Backpropagation of partial derivatives through
             the complete network up to layer 'upto'
@@ -443,6 +690,283 @@ class NeuralNetwork:
                      num_prev_weights+=size
                      # print(params)
 
+    #prune all the fully connected layers to the given sparsity
+    def prune(self, sparsity):
+        for layer in self.layers:
+            if isinstance(layer, FullyConnectedLayer):
+                layer.prune(sparsity)
+
+    #keep the pruned weights at zero after a parameter update
+    def apply_masks(self):
+        for layer in self.layers:
+            if isinstance(layer, FullyConnectedLayer):
+                layer.apply_mask()
+
+    #convert the weights of all the fully connected layers to a sparse format
+    def sparsify(self):
+        for layer in self.layers:
+            if isinstance(layer, FullyConnectedLayer):
+                layer.sparsify()
+
+    def prune_report(self, X, Y, dense_error=None, repeats=10):
+        """ Print sparsity and measured speedup of the sparse weights
+            for every fully connected layer, and the change in classification
+            error with respect to 'dense_error' (error of the unpruned network).
+            sparsify() has to be called before.
+        """
+        print("====================")
+        print("Pruning report")
+        print('{:>5} {:>12} {:>9} {:>11} {:>11} {:>8}'.format(
+              'layer', 'shape', 'sparsity', 'dense(ms)', 'sparse(ms)', 'speedup'))
+        X_next = X
+        for l, layer in enumerate(self.layers):
+            if isinstance(layer, FullyConnectedLayer):
+                # time only the matrix product of this layer on its real input
+                t_dense = float('inf')
+                t_sparse = float('inf')
+                for r in range(repeats):
+                    t0 = time.time()
+                    np.dot(X_next, layer.W)
+                    t_dense = min(t_dense, time.time() - t0)
+                    t0 = time.time()
+                    layer.W_sparse.dot(X_next.T)
+                    t_sparse = min(t_sparse, time.time() - t0)
+                print('{:>5} {:>12} {:>9.4f} {:>11.3f} {:>11.3f} {:>8.2f}'.format(
+                      l, '{}x{}'.format(*layer.W.shape), layer.sparsity(),
+                      t_dense*1000, t_sparse*1000, t_dense/t_sparse))
+                X_next = layer.fprop_sparse(X_next)
+            else:
+                X_next = layer.fprop(X_next)
+
+        t0 = time.time()
+        dense_pred = unhot(self.predict(X))
+        t1 = time.time()
+        sparse_pred = unhot(self.predict_sparse(X))
+        t2 = time.time()
+        sparse_error = np.mean(sparse_pred != Y)
+        print('predict: dense {:.1f}ms, sparse {:.1f}ms, speedup {:.2f}'.format(
+              (t1-t0)*1000, (t2-t1)*1000, (t1-t0)/(t2-t1)))
+        print('Classification error (pruned): {:.4f}'.format(sparse_error))
+        if dense_error is not None:
+            print('Accuracy delta w.r.t. dense network: {:+.4f}'.format(
+                  dense_error - sparse_error))
+        # dense and sparse inference sum in a different order, so near
+        # ties of the argmax can flip
+        print('Predictions differing between dense and sparse: {} of {}'.format(
+              np.sum(dense_pred != sparse_pred), dense_pred.shape[0]))
+        print("====================")
+
+    #replace the fully connected layer at 'index' by its low rank factorization
+    def factorize_layer(self, index, rank=None, energy=None):
+        self.layers[index] = low_rank_factorize(self.layers[index], rank, energy)
+        return self.layers[index]
+
+    #copy of the network that does not duplicate the inputs and
+    #activations cached by the last forward pass
+    def copy_without_caches(self):
+        memo = {}
+        for layer in self.layers:
+            for cache in ('last_input', 'last_proj'):
+                if hasattr(layer, cache):
+                    memo[id(getattr(layer, cache))] = None
+            act = getattr(layer, 'activation_fun', None)
+            if act is not None and hasattr(act, 'z'):
+                memo[id(act.z)] = None
+                memo[id(act.a)] = None
+        return copy.deepcopy(self, memo)
+
+    #loss and classification error for the given parameter vector
+    def val_metrics(self, params_all, X_val, Y_val, Yval):
+        self.set_all_params(params_all)
+        return self._loss(X_val, Y_val), self.classification_error(X_val, Yval)
+
+    #everything needed to resume training after epoch e, copied so that
+    #it can be written in the background while training goes on
+    def checkpoint_state(self, e, step_rprop, last_grad, step_gdm, train_arr, val_arr):
+        rng = np.random.get_state()
+        state = {'params': self.get_all_params(),
+                 'epoch': e,
+                 'step_rprop': np.copy(step_rprop),
+                 'last_grad': np.copy(last_grad),
+                 'step_gdm': np.copy(step_gdm),
+                 'train_arr': np.copy(train_arr),
+                 'val_arr': np.copy(val_arr),
+                 'rng_keys': rng[1],
+                 'rng_pos': rng[2],
+                 'rng_has_gauss': rng[3],
+                 'rng_cached_gaussian': rng[4]}
+        for l, layer in enumerate(self.layers):
+            if isinstance(layer, FullyConnectedLayer) and layer.mask is not None:
+                state['mask_{}'.format(l)] = np.copy(layer.mask)
+        return state
+
+    #restore parameters, pruning masks and RNG state from a checkpoint
+    #and return the whole checkpoint for the optimizer state and history
+    def load_checkpoint(self, filename):
+        with np.load(filename) as ckpt:
+            state = dict(ckpt)
+        self.set_all_params(state['params'])
+        for l, layer in enumerate(self.layers):
+            if 'mask_{}'.format(l) in state:
+                layer.mask = state['mask_{}'.format(l)]
+        np.random.set_state(('MT19937', state['rng_keys'], int(state['rng_pos']),
+                             int(state['rng_has_gauss']),
+                             float(state['rng_cached_gaussian'])))
+        return state
+
+    def memory_footprint(self, batch_size, training=True, descent_type="sgd",
+                         input_itemsize=4):
+        """ Estimate the memory in bytes needed per layer for a batch of
+            'batch_size' inputs. Returns a list of
+            (layer, params, grads, optimizer, activations, workspace) tuples:
+            - optimizer: the flat vectors train() keeps (rprop step and last
+              gradient, momentum step) and the temporary ones of the update
+            - activations: inputs and outputs cached by fprop
+            - workspace: temporaries of fprop (and bprop for training),
+              including the float64 copy of a float32 input made by np.dot
+            Gradients and optimizer state are only counted for training.
+        """
+        # flat vectors of the size of all parameters that are alive during
+        # an update: the persistent ones of train() and the temporaries
+        opt_vectors = {'sgd': 0, 'gd': 0, 'gdm': 2, 'rprop': 3}[descent_type]
+        if training:
+            opt_vectors += 3
+        in_itemsize = input_itemsize
+        rows = []
+        for layer in self.layers:
+            params = 0
+            grads = 0
+            optimizer = 0
+            activations = 0
+            workspace = 0
+            if isinstance(layer, InputLayer):
+                n_in = np.prod(layer.input_shape[1:])
+                activations = batch_size * n_in * input_itemsize
+            elif isinstance(layer, Parameterized):
+                params = sum(p.nbytes for p in layer.params())
+                itemsize = layer.params()[0].itemsize
+                in_bytes = batch_size * n_in * itemsize
+                out_bytes = batch_size * layer.num_units * itemsize
+                # net input z and, for an activation, its output a
+                activations = out_bytes
+                if layer.activation_fun is not None:
+                    activations += out_bytes
+                if isinstance(layer, LowRankLayer):
+                    activations += batch_size * layer.rank * itemsize
+                # np.dot converts a smaller input dtype first
+                upcast = in_bytes if in_itemsize < itemsize else 0
+                workspace = upcast + out_bytes
+                if training:
+                    grads = params
+                    optimizer = opt_vectors * params
+                    if getattr(layer, 'mask', None) is not None:
+                        optimizer += layer.mask.nbytes
+                    # activation derivative and delta, then the input gradient
+                    workspace = max(workspace, 2 * out_bytes + max(upcast, in_bytes))
+                n_in = layer.num_units
+                in_itemsize = itemsize
+            else:
+                # softmax output of the last layer and its two temporaries
+                activations = batch_size * n_in * 8
+                workspace = 2 * activations
+            rows.append((layer.__class__.__name__, params, grads, optimizer,
+                         activations, workspace))
+        return rows
+
+
+    def peak_memory(self, batch_size, training=True, descent_type="sgd",
+                    input_itemsize=4):
+        """ Estimate the peak memory in bytes of one forward (and for
+            training backward and update) pass by walking through the
+            layers: the outputs cached so far plus the workspace of the
+            current layer.
+        """
+        rows = self.memory_footprint(batch_size, training, descent_type, input_itemsize)
+        params, grads, optimizer, activations, workspace = \
+            np.sum([row[1:] for row in rows], axis=0)
+        base = params + (optimizer if training else 0)
+        peak = 0
+        cached = 0
+        for row in rows:
+            peak = max(peak, base + cached + row[5])
+            cached += row[4]
+        if training:
+            # bprop from the last layer: all caches are alive and the
+            # gradients of the layers above have been computed
+            grads_done = 0
+            for row in reversed(rows):
+                peak = max(peak, base + cached + grads_done + row[5])
+                grads_done += row[2]
+        peak = max(peak, base + cached + grads)
+        return peak
+
+
+    def measure_peak_rss(self, X, Y, batch_size, training=True):
+        """ Measure the increase of the peak resident set size in bytes for
+            one sgd step (or one predict) on a batch, including the copy of
+            the batch. It runs on a copy of the network without cached
+            activations. Linux only: the peak is reset through
+            /proc/self/clear_refs and read from VmHWM.
+        """
+        def proc_status(key):
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith(key):
+                        return int(line.split()[1]) * 1024
+
+        net = self.copy_without_caches()
+        Y_batch = one_hot(Y)[:batch_size]
+        rss_before = proc_status('VmRSS')
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        X_batch = np.copy(X[:batch_size])
+        if training:
+            net.sgd_epoch(X_batch, Y_batch, 0.0, batch_size)
+        else:
+            net.predict(X_batch)
+        return proc_status('VmHWM') - rss_before
+
+
+    def memory_report(self, train_batch_size, infer_batch_size, descent_type="sgd",
+                      X=None, Y=None):
+        """ Print the estimated memory per layer for training and inference.
+            Note that train() also evaluates the whole training set after
+            every epoch, so its size is the inference batch size to check.
+            If data (X, Y) is given, the estimated peak is compared to the
+            measured peak RSS increase of a step; the parameters and
+            optimizer state exist already and are left out of that.
+        """
+        def mb(n_bytes):
+            return n_bytes / 1024.0**2
+
+        for training, batch_size in ((True, train_batch_size), (False, infer_batch_size)):
+            rows = self.memory_footprint(batch_size, training, descent_type)
+            print("====================")
+            print("Memory estimate for {} with batch size {} (MB)".format(
+                  "training ({})".format(descent_type) if training else "inference",
+                  batch_size))
+            print('{:>5} {:>20} {:>9} {:>9} {:>10} {:>12} {:>10}'.format(
+                  'layer', 'type', 'params', 'grads', 'optimizer', 'activations',
+                  'workspace'))
+            for l, row in enumerate(rows):
+                print('{:>5} {:>20} {:>9.2f} {:>9.2f} {:>10.2f} {:>12.2f} {:>10.2f}'.format(
+                      l, row[0], *[mb(n_bytes) for n_bytes in row[1:]]))
+            totals = np.sum([row[1:] for row in rows], axis=0)
+            print('{:>26} {:>9.2f} {:>9.2f} {:>10.2f} {:>12.2f} {:>10}'.format(
+                  'total', mb(totals[0]), mb(totals[1]), mb(totals[2]), mb(totals[3]), '-'))
+            peak = self.peak_memory(batch_size, training, descent_type)
+            print('estimated peak: {:.2f} MB'.format(mb(peak)))
+            if X is not None:
+                # the measured step is plain sgd on a single batch, leave out
+                # the params and the three flat vectors train() keeps for sgd
+                step_peak = self.peak_memory(batch_size, training, "sgd") - totals[0]
+                if training:
+                    step_peak -= 3 * totals[0]
+                measured = self.measure_peak_rss(X, Y, batch_size, training)
+                print('step without params and optimizer state: estimated {:.2f} MB, '
+                      'measured peak RSS increase {:.2f} MB'.format(mb(step_peak), mb(measured)))
+        print("====================")
+
     #Rprop
     def rprop(self,X,Y,last_grad,step):
         former_grad = last_grad
@@ -469,6 +993,7 @@ class NeuralNetwork:
 
         former_grad = grads_all
         self.set_all_params(params_all)
+        self.apply_masks()
         return former_grad,step
 
 
@@ -493,6 +1018,7 @@ class NeuralNetwork:
                 if isinstance(layer,Parameterized):
                     for param,grad in zip(layer.params(),layer.grad_params()):
                         param -= learning_rate*grad
+            self.apply_masks()
 
     #gradient descent
     def gd_epoch(self, X, Y, learning_rate):
@@ -506,6 +1032,7 @@ class NeuralNetwork:
             if isinstance(layer,Parameterized):
                 for param,grad in zip(layer.params(),layer.grad_params()):
                     param -= learning_rate*grad
+        self.apply_masks()
 
     #gradient descent with momentum
     def gdm_epoch(self, X, Y, learning_rate,step):
@@ -518,15 +1045,36 @@ class NeuralNetwork:
 
         step = -learning_rate*self.get_all_grads() + mu*step
         self.set_all_params(np.add(self.get_all_params(),step))
+        self.apply_masks()
 
         return step
 
 
     def train(self, X, Y, X_val, Yval,learning_rate=0.1, max_epochs=100,
-              batch_size=64, descent_type="sgd", y_one_hot=True):
-        """ Train network on the given data. """
+              batch_size=64, descent_type="sgd", y_one_hot=True,
+              sparsity=0.0, prune_epochs=10, async_val=False,
+              checkpoint_file=None, checkpoint_every=1, resume_from=None):
+        """ Train network on the given data.
+            If sparsity > 0 the fully connected layers are pruned iteratively:
+            the pruned fraction is raised linearly to 'sparsity' over the
+            first 'prune_epochs' epochs (at most the whole run) and kept
+            fixed afterwards.
+            If async_val is True the validation metrics of each epoch are
+            computed in a background thread on a snapshot of the parameters
+            while the next epoch trains.
+            If checkpoint_file is given, the parameters, optimizer state, RNG
+            state, epoch counter and error history are written to it in the
+            background every 'checkpoint_every' epochs. Training continues
+            from such a file with resume_from.
+        """
         n_samples = X.shape[0]
 
+        if sparsity > 0 and prune_epochs > max_epochs+1:
+            # otherwise the run would end before reaching the target sparsity
+            print("... pruning over {} instead of {} epochs to reach sparsity {}".
+                  format(max_epochs+1, prune_epochs, sparsity))
+            prune_epochs = max_epochs+1
+
         # arrays for plotting
         val_arr = np.zeros(max_epochs+1)
         train_arr = np.zeros(max_epochs+1)
@@ -547,8 +1095,39 @@ class NeuralNetwork:
         # step for the gradient descent with momentum
         step_gdm = np.zeros(self.get_all_params().shape)
 
+        start_epoch = 0
+        if resume_from is not None:
+            state = self.load_checkpoint(resume_from)
+            step_rprop = state['step_rprop']
+            last_grad = state['last_grad']
+            step_gdm = state['step_gdm']
+            n_done = min(max_epochs+1, state['val_arr'].shape[0])
+            train_arr[:n_done] = state['train_arr'][:n_done]
+            val_arr[:n_done] = state['val_arr'][:n_done]
+            epochs[:n_done] = np.arange(n_done)
+            start_epoch = int(state['epoch']) + 1
+            print("... resuming training at epoch {}".format(start_epoch))
+        writer = None
+
+        def record_val(e, val_loss, val_error):
+            val_arr[e] = val_error
+            print('epoch {:.4f}, val_loss {:.4f}, val error {:.4f}'.
+                  format(e, val_loss, val_error))
+
+        if async_val:
+            # one worker thread with its own copy of the network, so the
+            # snapshots are evaluated in order and the layer caches of
+            # the network being trained are never touched
+            from concurrent.futures import ThreadPoolExecutor
+            evaluator = self.copy_without_caches()
+            executor = ThreadPoolExecutor(max_workers=1)
+            pending = []
+
         print("... starting training")
-        for e in range(max_epochs+1):
+        for e in range(start_epoch, max_epochs+1):
+            if sparsity > 0 and e < prune_epochs:
+                self.prune(sparsity * (e+1) / float(prune_epochs))
+
             if descent_type == "sgd":
                 self.sgd_epoch(X, Y_train, learning_rate, batch_size)
             elif descent_type == "gd":
@@ -569,13 +1148,44 @@ class NeuralNetwork:
                   format(e, train_loss, train_error))
 
             # Output error on the validation data
-            val_loss = self._loss(X_val, Y_val)
-            val_error = self.classification_error(X_val, Yval)
-            val_arr[e] = val_error
             epochs[e] = e
-            print('              val_loss {:.4f}, val error {:.4f}'.
-                  format(val_loss, val_error))
-
+            if async_val:
+                pending.append((e, executor.submit(evaluator.val_metrics,
+                                                   self.get_all_params(),
+                                                   X_val, Y_val, Yval)))
+                # merge the finished results, keeping the epoch order
+                while pending and pending[0][1].done():
+                    e_done, future = pending.pop(0)
+                    record_val(e_done, *future.result())
+            else:
+                val_loss = self._loss(X_val, Y_val)
+                val_error = self.classification_error(X_val, Yval)
+                val_arr[e] = val_error
+                print('              val_loss {:.4f}, val error {:.4f}'.
+                      format(val_loss, val_error))
+
+            if checkpoint_file is not None and ((e+1) % checkpoint_every == 0
+                                                or e == max_epochs):
+                if async_val:
+                    # the history in the checkpoint has to be complete
+                    for e_done, future in pending:
+                        record_val(e_done, *future.result())
+                    pending = []
+                state = self.checkpoint_state(e, step_rprop, last_grad, step_gdm,
+                                              train_arr, val_arr)
+                # only one checkpoint is written at a time
+                if writer is not None:
+                    writer.join()
+                writer = threading.Thread(target=save_checkpoint,
+                                          args=(checkpoint_file, state))
+                writer.start()
+
+        if async_val:
+            for e_done, future in pending:
+                record_val(e_done, *future.result())
+            executor.shutdown()
+        if writer is not None:
+            writer.join()
 
         plt.axis([0, max_epochs+1, 0, 100])
         plt.xlabel("Training Epochs")
@@ -586,6 +1196,112 @@ class NeuralNetwork:
         plt.legend()
 
 
+    def connect_workers(self, rank, world_size, host, port):
+        """ Rank 0 accepts a connection from every other worker, the others
+            connect to it. Returns the list of sockets of this worker.
+        """
+        if rank == 0:
+            server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            server.bind((host, port))
+            server.listen(world_size)
+            socks = [None] * world_size
+            for i in range(world_size - 1):
+                sock, _ = server.accept()
+                socks[recv_int(sock)] = sock
+            server.close()
+            socks = socks[1:]
+        else:
+            # rank 0 may not be listening yet
+            for attempt in range(100):
+                try:
+                    sock = socket.create_connection((host, port))
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            else:
+                raise ConnectionError("Could not connect to {}:{}".format(host, port))
+            send_int(sock, rank)
+            socks = [sock]
+        for sock in socks:
+            # the messages are sent as soon as a gradient is ready
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return socks
+
+
+    def allreduce_mean(self, socks, rank, world_size, vector):
+        """ Average 'vector' over all workers. Rank 0 collects the vectors
+            of all other workers and sends the mean back to them.
+        """
+        if world_size == 1:
+            return vector
+        if rank == 0:
+            total = np.copy(vector)
+            for sock in socks:
+                total += recv_vector(sock, vector.shape[0])
+            total /= world_size
+            for sock in socks:
+                send_vector(sock, total)
+            return total
+        send_vector(socks[0], vector)
+        return recv_vector(socks[0], vector.shape[0])
+
+
+    def train_distributed(self, X, Y, rank, world_size, host='localhost', port=5555,
+                          learning_rate=0.1, max_epochs=10, batch_size=64, y_one_hot=True):
+        """ Synchronous data parallel sgd over TCP. Every one of the
+            'world_size' workers calls this with its own shard (X, Y) of the
+            training data and its rank; rank 0 listens on (host, port).
+            After every minibatch the flat gradient vectors (get_all_grads())
+            are averaged over all workers, so every worker applies the same
+            update and the parameters stay identical everywhere.
+            Returns the duration of every epoch.
+        """
+        if y_one_hot:
+            # the width comes from the network, a shard may miss some classes
+            n_classes = [layer for layer in self.layers
+                         if isinstance(layer, Parameterized)][-1].num_units
+            Y_train = one_hot(Y, n_classes)
+        else:
+            Y_train = Y
+
+        socks = self.connect_workers(rank, world_size, host, port)
+        # start from the parameters of rank 0 and agree on the number
+        # of minibatches, the shards do not need to be of equal size
+        n_batches = X.shape[0] // batch_size
+        if rank == 0:
+            for sock in socks:
+                n_batches = min(n_batches, recv_int(sock))
+            for sock in socks:
+                send_vector(sock, self.get_all_params())
+                send_int(sock, n_batches)
+        else:
+            send_int(socks[0], n_batches)
+            self.set_all_params(recv_vector(socks[0], self.get_all_params().shape[0]))
+            n_batches = recv_int(socks[0])
+
+        epoch_times = []
+        for e in range(max_epochs):
+            t0 = time.time()
+            for b in range(n_batches):
+                batch_begin = b*batch_size
+                batch_end = batch_begin + batch_size
+                Y_pred = self.predict(X[batch_begin:batch_end])
+                self.backpropagate(Y_train[batch_begin:batch_end], Y_pred)
+                grads_all = self.allreduce_mean(socks, rank, world_size,
+                                                self.get_all_grads())
+                self.set_all_params(self.get_all_params() - learning_rate*grads_all)
+                self.apply_masks()
+            epoch_times.append(time.time() - t0)
+            if rank == 0:
+                print('epoch {:.4f}, workers {}, duration {:.2f}s'.
+                      format(e, world_size, epoch_times[-1]))
+
+        for sock in socks:
+            sock.close()
+        return epoch_times
+
+
     def test(self,X,Y,y_one_hot = True):
         if y_one_hot:
             Y_test = one_hot(Y)
@@ -701,6 +1417,276 @@ class NeuralNetwork:
                     param[:] = np.reshape(param_init, param_shape)
 
 
+def benchmark_activations(X_train, y_train, X_test, y_test,
+                          names=('sigmoid', 'hard_sigmoid', 'sigmoid_lut',
+                                 'tanh', 'hard_tanh', 'tanh_lut'),
+                          max_epochs=5, learning_rate=0.1, batch_size=100):
+    """ Compare the exact activation functions with their fast approximations:
+        throughput of fprop + bprop on a (batch_size, 100) array, and final
+        test error and training time of a 784-100-100-10 MLP trained with sgd.
+        'sigmoid_lut' and 'tanh_lut' are the exact functions with the
+        activation replaced by the interpolated tables.
+    """
+    tables = {'sigmoid_lut': sigmoid_lut, 'tanh_lut': tanh_lut}
+
+    def make_activation(name):
+        if name in tables:
+            act = Activation(name[:-len('_lut')])
+            act.act = tables[name]
+            return act
+        return Activation(name)
+
+    Y_train = one_hot(y_train)
+    z = np.random.normal(0, 3, (batch_size, 100))
+    grad = np.ones(z.shape)
+    x_err = np.linspace(-30, 30, 100001)
+    print("====================")
+    print('{:>14} {:>10} {:>14} {:>10} {:>10}'.format(
+          'activation', 'max error', 'Melements/s', 'train(s)', 'error'))
+    for name in names:
+        act = make_activation(name)
+
+        # maximum error with respect to the exact function
+        exact = sigmoid if 'sigmoid' in name else tanh
+        max_err = np.max(np.abs(act.act(x_err) - exact(x_err)))
+
+        repeats = 1000
+        t0 = time.time()
+        for r in range(repeats):
+            act.fprop(z)
+            act.bprop(grad)
+        throughput = repeats * z.size / (time.time() - t0) / 1e6
+
+        np.random.seed(0)
+        layers = [InputLayer((None, X_train.shape[1]))]
+        layers.append(FullyConnectedLayer(layers[-1], num_units=100, init_stddev=0.1,
+                                          activation_fun=make_activation(name)))
+        layers.append(FullyConnectedLayer(layers[-1], num_units=100, init_stddev=0.1,
+                                          activation_fun=make_activation(name)))
+        layers.append(FullyConnectedLayer(layers[-1], num_units=Y_train.shape[1],
+                                          init_stddev=0.1, activation_fun=None))
+        layers.append(SoftmaxOutput(layers[-1]))
+        net = NeuralNetwork(layers)
+        t0 = time.time()
+        for e in range(max_epochs):
+            net.sgd_epoch(X_train, Y_train, learning_rate, batch_size)
+        t_train = time.time() - t0
+        error = net.classification_error(X_test, y_test)
+        print('{:>14} {:>10.2e} {:>14.1f} {:>10.1f} {:>10.4f}'.format(
+              name, max_err, throughput, t_train, error))
+    print("====================")
+
+# helpers for exchanging flat float64 vectors and integers
+# between the workers of train_distributed()
+def recv_exact(sock, n_bytes):
+    buf = bytearray(n_bytes)
+    view = memoryview(buf)
+    received = 0
+    while received < n_bytes:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            raise ConnectionError("Worker connection closed")
+        received += n
+    return buf
+
+def send_vector(sock, vector):
+    sock.sendall(np.ascontiguousarray(vector, dtype=np.float64).tobytes())
+
+def recv_vector(sock, size):
+    return np.frombuffer(recv_exact(sock, size * 8), dtype=np.float64)
+
+def send_int(sock, value):
+    sock.sendall(struct.pack('!i', value))
+
+def recv_int(sock):
+    return struct.unpack('!i', bytes(recv_exact(sock, 4)))[0]
+
+def distributed_worker(nn, X, Y, rank, world_size, port, kwargs, results):
+    # entry point of the local worker processes of distributed_scaling_report()
+    epoch_times = nn.train_distributed(X, Y, rank, world_size, port=port, **kwargs)
+    if rank == 0:
+        results.put(epoch_times)
+
+def distributed_scaling_report(nn, X, Y, worker_counts=(1, 2, 4), port=5555,
+                               max_epochs=2, **kwargs):
+    """ Run train_distributed() with local worker processes on localhost for
+        every worker count and print the epoch time, speedup and scaling
+        efficiency (speedup / #workers). Every worker trains a copy of nn on
+        its 1/N shard of (X, Y). Limit the BLAS threads per process
+        (e.g. OMP_NUM_THREADS=1) to measure the scaling over processes.
+        The workers are forked (POSIX only): this script trains at module
+        level without a __main__ guard, so with spawn or forkserver every
+        worker would import it and rerun the whole script.
+        Raises RuntimeError if a worker fails.
+    """
+    import multiprocessing
+    import queue
+    mp = multiprocessing.get_context('fork')
+    shards_all = np.arange(X.shape[0])
+    t_single = None
+    print("====================")
+    print('{:>8} {:>14} {:>10} {:>11}'.format('workers', 'epoch time(s)',
+                                              'speedup', 'efficiency'))
+    for n, world_size in enumerate(worker_counts):
+        results = mp.Queue()
+        workers = []
+        for rank, shard in enumerate(np.array_split(shards_all, world_size)):
+            worker = mp.Process(
+                target=distributed_worker,
+                args=(nn, X[shard], Y[shard], rank, world_size, port + n,
+                      dict(kwargs, max_epochs=max_epochs), results))
+            worker.start()
+            workers.append(worker)
+        # rank 0 reports the epoch times, the other workers are only
+        # checked for failures while waiting for them
+        epoch_times = None
+        while epoch_times is None:
+            try:
+                epoch_times = results.get(timeout=1.0)
+            except queue.Empty:
+                failed = [worker for worker in workers
+                          if worker.exitcode not in (None, 0)]
+                if failed:
+                    for worker in workers:
+                        worker.terminate()
+                    raise RuntimeError("distributed worker exited with code {}".format(
+                                       failed[0].exitcode))
+        for worker in workers:
+            worker.join()
+        # leave out the first epoch as warm-up
+        t_epoch = np.mean(epoch_times[1:]) if len(epoch_times) > 1 else epoch_times[0]
+        if t_single is None:
+            t_single = t_epoch * worker_counts[0]
+        speedup = t_single / t_epoch
+        print('{:>8} {:>14.2f} {:>10.2f} {:>11.2f}'.format(
+              world_size, t_epoch, speedup, speedup / world_size))
+    print("====================")
+
+def project_data(X_train, X_val, X_test, method, k, cache_dir='./data', seed=0):
+    """ Fit an InputProjection on the training data and project all three
+        sets. The projection matrix and the projected sets are cached in
+        cache_dir, so later runs only load k instead of 784 features.
+        The cache file is keyed by the shapes and a sample of the rows of
+        the three sets, so subsampled or changed data is projected again.
+    """
+    key = hashlib.sha1()
+    for X in (X_train, X_val, X_test):
+        key.update(str(X.shape).encode('ascii'))
+        key.update(np.ascontiguousarray(X[::max(1, X.shape[0] // 1000)]).tobytes())
+    cache_file = os.path.join(cache_dir, 'mnist_{}_{}_{}_{}.npz'.format(
+        method, k, seed, key.hexdigest()[:12]))
+    projection = InputProjection(method, k, seed)
+    if os.path.exists(cache_file):
+        print('... loading projected data from', cache_file)
+        with np.load(cache_file) as cache:
+            projection.mean = cache['mean']
+            projection.P = cache['P']
+            return projection, cache['X_train'], cache['X_val'], cache['X_test']
+
+    print('... fitting {} projection to {} features'.format(method, k))
+    projection.fit(X_train)
+    X_train_p = projection.transform(X_train)
+    X_val_p = projection.transform(X_val)
+    X_test_p = projection.transform(X_test)
+    if not os.path.exists(cache_dir):
+        os.mkdir(cache_dir)
+    save_checkpoint(cache_file, {'mean': projection.mean, 'P': projection.P,
+                                 'X_train': X_train_p, 'X_val': X_val_p,
+                                 'X_test': X_test_p})
+    return projection, X_train_p, X_val_p, X_test_p
+
+def projection_curve(X_train, y_train, X_val, X_test, y_test, ks, method='pca',
+                     max_epochs=5, learning_rate=0.1, batch_size=100):
+    """ Train a k-100-100-10 MLP on the projected inputs for every k
+        (and on the raw inputs for comparison) and plot the mean epoch
+        time against the test error.
+    """
+    Y_train = one_hot(y_train)
+    results = []
+    print("====================")
+    print('{:>6} {:>14} {:>10}'.format('k', 'epoch time(s)', 'error'))
+    for k in [None] + list(ks):
+        if k is None:
+            X_tr, X_te = X_train, X_test
+        else:
+            projection, X_tr, X_va, X_te = project_data(X_train, X_val, X_test, method, k)
+        np.random.seed(0)
+        layers = [InputLayer((None, X_tr.shape[1]))]
+        layers.append(FullyConnectedLayer(layers[-1], num_units=100, init_stddev=0.01,
+                                          activation_fun=Activation('relu')))
+        layers.append(FullyConnectedLayer(layers[-1], num_units=100, init_stddev=0.01,
+                                          activation_fun=Activation('relu')))
+        layers.append(FullyConnectedLayer(layers[-1], num_units=Y_train.shape[1],
+                                          init_stddev=0.01, activation_fun=None))
+        layers.append(SoftmaxOutput(layers[-1]))
+        net = NeuralNetwork(layers)
+        t0 = time.time()
+        for e in range(max_epochs):
+            net.sgd_epoch(X_tr, Y_train, learning_rate, batch_size)
+        t_epoch = (time.time() - t0) / max_epochs
+        error = net.classification_error(X_te, y_test)
+        results.append((X_tr.shape[1], t_epoch, error))
+        print('{:>6} {:>14.2f} {:>10.4f}'.format(X_tr.shape[1], t_epoch, error))
+    print("====================")
+
+    plt.figure()
+    plt.xlabel("Epoch time (s)")
+    plt.ylabel("Error(%)")
+    plt.plot([r[1] for r in results], [r[2]*100 for r in results], 'o-')
+    for n_features, t_epoch, error in results:
+        plt.annotate(str(n_features), (t_epoch, error*100))
+    plt.title("Epoch time vs test error ({} inputs)".format(method))
+    return results
+
+def save_checkpoint(filename, state):
+    """ Write a checkpoint atomically: it is written to a temporary file
+        first which then replaces the old checkpoint, so a job killed while
+        writing always leaves a complete checkpoint behind.
+    """
+    tmp_file = filename + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        np.savez(f, **state)
+    os.replace(tmp_file, filename)
+
+def low_rank_report(nn, index, ranks, X_test, y_test, X_train=None, y_train=None,
+                    fine_tune_epochs=0, learning_rate=0.1, batch_size=100, repeats=5):
+    """ Print the speed/accuracy trade-off of replacing layer 'index' of
+        the trained network nn by low rank factorizations of the given ranks.
+        If fine_tune_epochs > 0 every factorized network is fine-tuned with
+        sgd on (X_train, y_train) before testing. nn itself is not changed.
+    """
+    def time_predict(net):
+        t_best = float('inf')
+        for r in range(repeats):
+            t0 = time.time()
+            net.predict(X_test)
+            t_best = min(t_best, time.time() - t0)
+        return t_best
+
+    t_full = time_predict(nn)
+    error_full = nn.classification_error(X_test, y_test)
+    n_full = nn.layers[index].W.size
+    print("====================")
+    print("Low rank report for layer {} ({}x{})".format(index, *nn.layers[index].W.shape))
+    print('{:>6} {:>9} {:>12} {:>9} {:>9} {:>10}'.format(
+          'rank', 'params', 'predict(ms)', 'speedup', 'error', 'delta'))
+    print('{:>6} {:>9} {:>12.1f} {:>9.2f} {:>9.4f} {:>10}'.format(
+          'full', n_full, t_full*1000, 1.0, error_full, '-'))
+    for rank in ranks:
+        net = copy.deepcopy(nn)
+        layer = net.factorize_layer(index, rank=rank)
+        if fine_tune_epochs > 0:
+            Y_train = one_hot(y_train)
+            for e in range(fine_tune_epochs):
+                net.sgd_epoch(X_train, Y_train, learning_rate, batch_size)
+        t_rank = time_predict(net)
+        error = net.classification_error(X_test, y_test)
+        print('{:>6} {:>9} {:>12.1f} {:>9.2f} {:>9.4f} {:>+10.4f}'.format(
+              rank, layer.U.size + layer.V.size, t_rank*1000, t_full/t_rank,
+              error, error - error_full))
+    print("====================")
+
+
 #Gradient Checking
 
 # input_shape = (5, 10)
@@ -805,9 +1791,67 @@ nn = NeuralNetwork(layers)
 t0 = time.time()
 nn.train(X_train, y_train, X_val, y_val, learning_rate=0.35,
         max_epochs=30, batch_size=100,descent_type="sgd", y_one_hot=True)
+# to survive preemption write a checkpoint every 5 epochs
+# (checkpoint_file='./data/nn_checkpoint.npz', checkpoint_every=5)
+# and continue an interrupted run with resume_from='./data/nn_checkpoint.npz'
 t1 = time.time()
 print('Duration: {:.1f}s'.format(t1-t0))
 nn.test(X_test,y_test)
 
+#Pruning
+# prune the trained network to 90% sparsity while fine-tuning it
+# and compare the sparse inference against the dense one
+
+# dense_error = nn.classification_error(X_test, y_test)
+# nn.train(X_train, y_train, X_val, y_val, learning_rate=0.1,
+#         max_epochs=10, batch_size=100, descent_type="sgd", y_one_hot=True,
+#         sparsity=0.9, prune_epochs=5)
+# nn.sparsify()
+# nn.prune_report(X_test, y_test, dense_error)
+
+#Input projection
+# epoch time vs accuracy when training on k PCA features instead of 784 pixels
+
+# projection_curve(X_train, y_train, X_val, X_test, y_test, [16, 32, 64, 128],
+#                  method='pca', max_epochs=5)
+# or train the network above on 64 cached PCA features
+# projection, X_train, X_val, X_test = project_data(X_train, X_val, X_test, 'pca', 64)
+# (with input_shape = (None, 64))
+
+#Memory footprint
+# estimated memory per layer for training with batches of 100 and for the
+# evaluation of the whole training set, checked against the measured peak RSS
+
+# nn.memory_report(100, X_train.shape[0], descent_type="sgd", X=X_train, Y=y_train)
+
+#Distributed training
+# scaling efficiency with 1, 2 and 4 local worker processes
+
+# distributed_scaling_report(nn, X_train, y_train, worker_counts=(1, 2, 4),
+#                            learning_rate=0.35, batch_size=100)
+# on several nodes run this script on every node with its own NN_RANK,
+# NN_WORLD_SIZE and the address of the rank 0 node in NN_MASTER
+# rank = int(os.environ['NN_RANK'])
+# world_size = int(os.environ['NN_WORLD_SIZE'])
+# shard = np.array_split(np.arange(X_train.shape[0]), world_size)[rank]
+# nn.train_distributed(X_train[shard], y_train[shard], rank, world_size,
+#                      host=os.environ['NN_MASTER'], port=5555,
+#                      learning_rate=0.35, max_epochs=30, batch_size=100)
+
+#Fast activation functions
+# error bound, throughput and MNIST accuracy of the approximations
+# against the exact sigmoid and tanh
+
+# benchmark_activations(X_train, y_train, X_test, y_test, max_epochs=5)
+
+#Low rank factorization
+# speed/accuracy trade-off of factorizing the 784x100 first layer,
+# each rank fine-tuned for 2 epochs
+
+# low_rank_report(nn, 1, [5, 10, 20, 40], X_test, y_test, X_train, y_train,
+#                 fine_tune_epochs=2, learning_rate=0.1)
+# or replace it in place keeping 90% of the spectral energy
+# nn.factorize_layer(1, energy=0.9)
+
 plt.show()
 
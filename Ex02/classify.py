@@ -0,0 +1,122 @@
+"""Batch inference with a frozen graph exported by convolutional.py --export_graph."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import time
+
+import numpy
+from six.moves import xrange  # pylint: disable=redefined-builtin
+import tensorflow as tf
+import input_data
+
+# Names of the input and output of the exported graph (see convolutional.py).
+EXPORT_INPUT = 'images'
+EXPORT_OUTPUT = 'predictions'
+
+
+def load_frozen_graph(filename):
+  """Import a frozen graph into a new tf.Graph."""
+  graph_def = tf.GraphDef()
+  with tf.gfile.GFile(filename, 'rb') as f:
+    graph_def.ParseFromString(f.read())
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name='')
+  return graph
+
+
+def load_inputs(path, depth_dir=None):
+  """Load the images to classify and their names.
+
+  path is either a .npy file with a [num images, IMAGE_SIZE, IMAGE_SIZE, channels]
+  uint8 batch, or a directory of *_crop.png images. For RGB-D the depth
+  maps are read from depth_dir.
+  """
+  if path.endswith('.npy'):
+    images = numpy.load(path, mmap_mode='r')
+    if images.dtype != numpy.uint8:
+      # Images in [0.0, 1.0] as stored by older versions of input_data.py
+      images = numpy.rint(numpy.multiply(images, 255.0)).astype(numpy.uint8)
+    names = [str(i) for i in xrange(images.shape[0])]
+    return names, images
+  names = sorted(f[:-len('.png')] for f in os.listdir(path) if f.endswith('_crop.png'))
+  if depth_dir:
+    images = input_data.load_rgbd_images(names, path, depth_dir, '.png')
+  else:
+    images = input_data.load_images(names, path, '.png')
+  return names, images
+
+
+def main():
+  graph = load_frozen_graph(FLAGS.graph)
+  images_node = graph.get_tensor_by_name(EXPORT_INPUT + ':0')
+  predictions_node = graph.get_tensor_by_name(EXPORT_OUTPUT + ':0')
+  names, images = load_inputs(FLAGS.inputs, FLAGS.depth_dir)
+
+  config = tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                          inter_op_parallelism_threads=FLAGS.inter_op_threads)
+  size = images.shape[0]
+  predictions = numpy.ndarray(shape=(size, predictions_node.get_shape()[1].value),
+                              dtype=numpy.float32)
+  start_time = time.time()
+  with tf.Session(graph=graph, config=config) as sess:
+    for begin in xrange(0, size, FLAGS.batch_size):
+      end = min(begin + FLAGS.batch_size, size)
+      predictions[begin:end] = sess.run(predictions_node,
+                                        feed_dict={images_node: images[begin:end]})
+  duration = time.time() - start_time
+  print('Classified %d images in %.2f s (%.1f images/sec)' % (size, duration, size / duration))
+
+  labels = numpy.argmax(predictions, 1)
+  if FLAGS.output:
+    numpy.save(FLAGS.output, predictions)
+    print('Saved predictions to', FLAGS.output)
+  else:
+    for i in xrange(size):
+      print('%s %d %.4f' % (names[i], labels[i], predictions[i, labels[i]]))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      'graph',
+      help='Frozen graph written by convolutional.py --export_graph.'
+  )
+  parser.add_argument(
+      'inputs',
+      help='Directory of *_crop.png images or .npy file with a uint8 image batch.'
+  )
+  parser.add_argument(
+      '--depth_dir',
+      default='',
+      help='Directory of the *_depthcrop.png depth maps (RGB-D graphs only).'
+  )
+  parser.add_argument(
+      '--batch_size',
+      type=int,
+      default=4096,
+      help='Number of images per session run.'
+  )
+  parser.add_argument(
+      '--output',
+      default='',
+      help='Save the class probabilities to this .npy file instead of printing the labels.'
+  )
+  parser.add_argument(
+      '--intra_op_threads',
+      type=int,
+      default=0,
+      help='Threads used inside a single op such as a convolution (0: TensorFlow default).'
+  )
+  parser.add_argument(
+      '--inter_op_threads',
+      type=int,
+      default=0,
+      help='Threads used to run independent ops in parallel (0: TensorFlow default).'
+  )
+  FLAGS = parser.parse_args()
+  main()
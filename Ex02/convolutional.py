@@ -22,7 +22,9 @@ from __future__ import print_function
 
 import argparse
 import gzip
+import hashlib
 import os
+import shutil
 import sys
 import time
 
@@ -30,7 +32,9 @@ import numpy
 from six.moves import urllib
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
-import sklearn
+from tensorflow.python.client import timeline
+from tensorflow.python.framework import graph_util
+from sklearn.metrics import confusion_matrix
 import input_data
 from matplotlib import pyplot as plt
 
@@ -46,6 +50,12 @@ BATCH_SIZE = 64
 NUM_EPOCHS = 10
 EVAL_BATCH_SIZE = 1024
 EVAL_FREQUENCY = 100  # Number of steps between evaluations.
+VAL_SUBSAMPLE = 1024  # Validation examples used for the frequent evaluations.
+# Names of the input and output of the exported inference graph.
+EXPORT_INPUT = 'images'
+EXPORT_OUTPUT = 'predictions'
+# Version of the feature cache layout of --train_head, part of its key.
+FEATURE_CACHE_VERSION = 2
 # This is where the data gets stored
 #TRAIN_DIR = 'data'
 # HINT:
@@ -64,20 +74,146 @@ def error_rate(predictions, labels):
 
 def fake_data(num_images, channels):
   """Generate a fake dataset that matches the dimensions of rgbd_10 dataset."""
-  data = numpy.ndarray(
+  data = numpy.zeros(
       shape=(num_images, IMAGE_SIZE, IMAGE_SIZE, channels),
-      dtype=numpy.float32)
+      dtype=numpy.uint8)
   labels = numpy.zeros(shape=(num_images,), dtype=numpy.int64)
   for image in xrange(num_images):
     label = image % 2
-    data[image, :, :, 0] = label - 0.5
+    data[image, :, :, 0] = label * 255
     labels[image] = label
   return data, labels
 
 
+def normalize_images(x):
+  """Convert uint8 images from [0, 255] -> [0.0, 1.0] inside the graph."""
+  return tf.cast(x, data_type()) * (1.0 / 255.0)
+
+def session_config():
+  """Session configuration with the thread pool sizes from the flags (0: chosen by TensorFlow)."""
+  return tf.ConfigProto(intra_op_parallelism_threads=FLAGS.intra_op_threads,
+                        inter_op_parallelism_threads=FLAGS.inter_op_threads)
+
+def print_throughput(name, step_times, batch_size):
+  """Print images/sec and step latency percentiles of timed steps."""
+  step_times = numpy.array(step_times)
+  print('%s: %.1f images/sec, step latency p50 %.2f ms, p90 %.2f ms, p99 %.2f ms' %
+        (name, batch_size * len(step_times) / numpy.sum(step_times),
+         1000 * numpy.percentile(step_times, 50), 1000 * numpy.percentile(step_times, 90),
+         1000 * numpy.percentile(step_times, 99)))
+
+def export_frozen_graph(sess, filename):
+  """Write the inference graph with the weights folded in as constants.
+
+  Only the ops needed for EXPORT_OUTPUT are kept, see classify.py for
+  running the exported graph.
+  """
+  frozen_graph = graph_util.convert_variables_to_constants(
+      sess, sess.graph.as_graph_def(), [EXPORT_OUTPUT])
+  with tf.gfile.GFile(filename, 'wb') as f:
+    f.write(frozen_graph.SerializeToString())
+  print('Exported frozen inference graph (%d ops) to %s' % (len(frozen_graph.node), filename))
+
+def write_profile(run_metadatas, python_times, profile_dir, top=20):
+  """Write Chrome-trace timelines of the profiled steps and print per-op and Python-side summaries.
+
+  run_metadatas holds the FULL_TRACE RunMetadata of every profiled step,
+  python_times the (next batch, feed_dict, session run, error rate)
+  durations in seconds of the same steps. The timelines can be opened
+  in chrome://tracing.
+  """
+  if not os.path.exists(profile_dir):
+    os.makedirs(profile_dir)
+  op_time = {}
+  op_bytes = {}
+  type_time = {}
+  for i, run_metadata in enumerate(run_metadatas):
+    trace = timeline.Timeline(run_metadata.step_stats)
+    with open(os.path.join(profile_dir, 'timeline_%d.json' % i), 'w') as f:
+      f.write(trace.generate_chrome_trace_format(show_memory=True))
+    for dev_stats in run_metadata.step_stats.dev_stats:
+      for node_stats in dev_stats.node_stats:
+        name = node_stats.node_name
+        micros = node_stats.all_end_rel_micros
+        op_time[name] = op_time.get(name, 0) + micros
+        op_bytes[name] = op_bytes.get(name, 0) + sum(
+            output.tensor_description.allocation_description.requested_bytes
+            for output in node_stats.output)
+        # the label reads "<name> = <op type>(<inputs>)"
+        op_type = node_stats.timeline_label.split(' = ')[-1].split('(')[0]
+        type_time[op_type] = type_time.get(op_type, 0) + micros
+  num_steps = len(run_metadatas)
+  total_time = sum(op_time.values())
+  print('Wrote %d timelines to %s' % (num_steps, profile_dir))
+  print('%-50s %10s %7s %12s' % ('op', 'ms/step', '%', 'KB out/step'))
+  for name in sorted(op_time, key=op_time.get, reverse=True)[:top]:
+    print('%-50s %10.3f %7.2f %12.1f' % (name, op_time[name] / 1000.0 / num_steps,
+                                         100.0 * op_time[name] / total_time,
+                                         op_bytes[name] / 1024.0 / num_steps))
+  print('%-50s %10s %7s' % ('op type', 'ms/step', '%'))
+  for op_type in sorted(type_time, key=type_time.get, reverse=True)[:top]:
+    print('%-50s %10.3f %7.2f' % (op_type, type_time[op_type] / 1000.0 / num_steps,
+                                  100.0 * type_time[op_type] / total_time))
+  python_times = 1000.0 * numpy.mean(python_times, axis=0)
+  print('Python side per step: next batch %.3f ms, feed_dict %.3f ms, session run %.3f ms, '
+        'error rate %.3f ms' % tuple(python_times))
+
+def feature_cache_dir(checkpoint, splits):
+  """Directory of the cached trunk features of checkpoint.
+
+  It is keyed by the checkpoint path and modification time, the input
+  preprocessing and the shapes of the splits, so retraining the trunk or
+  changing the data uses a new cache.
+  """
+  key = hashlib.sha1()
+  key.update(os.path.abspath(checkpoint).encode('utf-8'))
+  for filename in (checkpoint, checkpoint + '.index'):
+    if os.path.exists(filename):
+      key.update(('%f' % os.path.getmtime(filename)).encode('ascii'))
+  key.update(('%d %d %d' % (FEATURE_CACHE_VERSION, input_data.CACHE_VERSION, IMAGE_SIZE)).encode('ascii'))
+  for name, data in splits:
+    key.update(('%s %s' % (name, data.shape)).encode('ascii'))
+  return os.path.join(FLAGS.feature_cache, key.hexdigest())
+
+def load_features(cache_dir, names):
+  """Memory-map the cached features of the named splits and load their labels.
+
+  The labels are the ones the features were computed with, the order of
+  the examples differs between runs that do not use the dataset cache.
+  """
+  print('Loading features from', cache_dir)
+  features = [numpy.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r') for name in names]
+  labels = [numpy.load(os.path.join(cache_dir, name + '_labels.npy')) for name in names]
+  return features, labels
+
+def save_features(cache_dir, names, features, labels):
+  """Save the features of the named splits and their labels.
+
+  Like the dataset cache (see input_data.save_data_sets_cache) they are
+  written to a temporary directory of this process that is renamed when
+  complete, and saving is best effort: if the cache cannot be written or
+  another run saved it first, the computed features are used uncached.
+  """
+  tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+  try:
+    if os.path.exists(tmp_dir):
+      shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for name, split_features, split_labels in zip(names, features, labels):
+      numpy.save(os.path.join(tmp_dir, name + '.npy'), split_features)
+      numpy.save(os.path.join(tmp_dir, name + '_labels.npy'), split_labels)
+    os.rename(tmp_dir, cache_dir)
+    print('Saved features to', cache_dir)
+  except (IOError, OSError) as e:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if os.path.exists(cache_dir):
+      print('Features were saved by another run to', cache_dir)
+    else:
+      print('Could not save features to %s (%s), continuing without them' % (cache_dir, e))
+
 #classic way, stride of 1 and padding makes it preserve the size of the image
-def conv2d(x, W):
-    return tf.nn.conv2d(x, W, strides=[1, 1, 1, 1], padding='SAME')
+def conv2d(x, W, name=None):
+    return tf.nn.conv2d(x, W, strides=[1, 1, 1, 1], padding='SAME', name=name)
 
 def max_pool_2x2(x):
     return tf.nn.max_pool(x, ksize=[1, 2, 2, 1], strides=[1, 2, 2, 1], padding='SAME')
@@ -92,10 +228,21 @@ def bias_variable(shape):
 
 
 def main(argv=None):  # pylint: disable=unused-argument
-  if FLAGS.self_test:
+  # Every tower gets BATCH_SIZE examples of the global batch
+  global_batch_size = BATCH_SIZE * FLAGS.num_towers
+  if FLAGS.benchmark:
+    print('Running benchmark on fake data.')
+    NUM_CHANNELS = 4 if FLAGS.use_rgbd else 3
+    train_data, train_labels = fake_data(global_batch_size, NUM_CHANNELS)
+    train_set = input_data.DataSet(train_data, train_labels, False, FLAGS.use_rgbd)
+    validation_data, validation_labels = fake_data(EVAL_BATCH_SIZE, NUM_CHANNELS)
+    test_data, test_labels = validation_data, validation_labels
+    num_epochs = 0
+  elif FLAGS.self_test:
     print('Running self-test.')
-    NUM_CHANNELS = 1
+    NUM_CHANNELS = 3
     train_data, train_labels = fake_data(256, NUM_CHANNELS)
+    train_set = input_data.DataSet(train_data, train_labels)
     validation_data, validation_labels = fake_data(EVAL_BATCH_SIZE, NUM_CHANNELS)
     test_data, test_labels = fake_data(EVAL_BATCH_SIZE, NUM_CHANNELS)
     num_epochs = 1
@@ -113,9 +260,13 @@ def main(argv=None):  # pylint: disable=unused-argument
       print('* Channels: 3               *')
       print('*****************************')
     # Load input data
-    data_sets = input_data.read_data_sets(TRAIN_DIR, FLAGS.use_rgbd)
+    data_sets = input_data.read_data_sets(TRAIN_DIR, FLAGS.use_rgbd,
+                                          use_cache=not FLAGS.no_cache,
+                                          from_tar=FLAGS.from_tar,
+                                          cache_dir=FLAGS.cache_dir or None)
     num_epochs = NUM_EPOCHS
 
+    train_set = data_sets.train
     train_data = data_sets.train.images  # (27999, 32, 32, 3)
     train_labels= data_sets.train.labels
   
@@ -126,10 +277,23 @@ def main(argv=None):  # pylint: disable=unused-argument
     validation_labels = data_sets.validation.labels
   
   train_size = train_labels.shape[0]
+
+  # Fixed random subset of the validation data for the frequent evaluations,
+  # the whole validation set is evaluated at the end of every epoch
+  val_size = validation_labels.shape[0]
+  if 0 < FLAGS.val_subsample < val_size:
+    val_subset = numpy.sort(numpy.random.choice(val_size, FLAGS.val_subsample, replace=False))
+    validation_subsample = validation_data[val_subset]
+    validation_subsample_labels = validation_labels[val_subset]
+  else:
+    validation_subsample = validation_data
+    validation_subsample_labels = validation_labels
  
-  train_data_node = tf.placeholder(data_type(), shape=(BATCH_SIZE, IMAGE_SIZE, IMAGE_SIZE, NUM_CHANNELS))
-  train_labels_node = tf.placeholder(tf.int64, shape=(BATCH_SIZE,))
-  eval_data = tf.placeholder(data_type(), shape=(EVAL_BATCH_SIZE, IMAGE_SIZE, IMAGE_SIZE, NUM_CHANNELS))
+  # The images are fed as uint8, a quarter of the bytes of float32
+  train_data_node = tf.placeholder(tf.uint8, shape=(global_batch_size, IMAGE_SIZE, IMAGE_SIZE, NUM_CHANNELS))
+  train_labels_node = tf.placeholder(tf.int64, shape=(global_batch_size,))
+  # The batch dimension is left open so the last batch can be smaller
+  eval_data = tf.placeholder(tf.uint8, shape=(None, IMAGE_SIZE, IMAGE_SIZE, NUM_CHANNELS))
   keep_prob = tf.placeholder(tf.float32)
 
 
@@ -137,16 +301,10 @@ def main(argv=None):  # pylint: disable=unused-argument
   def eval_in_batches(data, sess):
     """Get all predictions for a dataset by running it in small batches."""
     size = data.shape[0]
-    if size < EVAL_BATCH_SIZE:
-      raise ValueError("batch size for evals larger than dataset: %d" % size)
     predictions = numpy.ndarray(shape=(size, NUM_LABELS), dtype=numpy.float32)
     for begin in xrange(0, size, EVAL_BATCH_SIZE):
-      end = begin + EVAL_BATCH_SIZE
-      if end <= size:
-        predictions[begin:end, :] = sess.run(eval_prediction,feed_dict={eval_data: data[begin:end, ...],keep_prob:1})                    
-      else:
-        batch_predictions = sess.run(eval_prediction,feed_dict={eval_data: data[-EVAL_BATCH_SIZE:, ...],keep_prob:1})
-        predictions[begin:, :] = batch_predictions[begin - size:, :]
+      end = min(begin + EVAL_BATCH_SIZE, size)
+      predictions[begin:end, :] = sess.run(eval_prediction,feed_dict={eval_data: data[begin:end, ...],keep_prob:1})
     return predictions
 
     
@@ -173,99 +331,328 @@ def main(argv=None):  # pylint: disable=unused-argument
   W_out = weight_variable([256, NUM_LABELS])
   b_out = bias_variable([NUM_LABELS])
 
-  #Define the architecture
-  def conv_nn(x,keep_prob):
+  #Define the architecture, split into the conv trunk and the fully connected head
+  def conv_trunk(x):
+    x = normalize_images(x)
+
     ######First layer ########
-    h_conv11 = conv2d(x, W_conv11) + b_conv11
+    h_conv11 = conv2d(x, W_conv11, 'conv11') + b_conv11
     h_relu11 = tf.nn.relu(h_conv11)
-    h_conv12 = conv2d(h_relu11, W_conv12) + b_conv12
+    h_conv12 = conv2d(h_relu11, W_conv12, 'conv12') + b_conv12
     h_relu12 = tf.nn.relu(h_conv12)
     h_pool11 = max_pool_2x2(h_relu12)
 
     ##### Second layer #######
-    h_conv21 = conv2d(h_pool11, W_conv21) + b_conv21
+    h_conv21 = conv2d(h_pool11, W_conv21, 'conv21') + b_conv21
     h_relu21 = tf.nn.relu(h_conv21)
-    h_conv22 = conv2d(h_relu21, W_conv22) + b_conv22
+    h_conv22 = conv2d(h_relu21, W_conv22, 'conv22') + b_conv22
     h_relu22 = tf.nn.relu(h_conv22)    
     h_pool21 = max_pool_2x2(h_relu22)
 
     ##### Third layer #######
-    h_conv31 = conv2d(h_pool21, W_conv31) + b_conv31
+    h_conv31 = conv2d(h_pool21, W_conv31, 'conv31') + b_conv31
     h_relu31 = tf.nn.relu(h_conv31)
-    h_conv32 = conv2d(h_relu31, W_conv32) + b_conv32
+    h_conv32 = conv2d(h_relu31, W_conv32, 'conv32') + b_conv32
     h_relu32 = tf.nn.relu(h_conv32)    
     h_pool31 = max_pool_2x2(h_relu32)
 
 
-    ###### Fully connected layer ####
     h_pool31_flat = tf.reshape(h_pool31, [-1, 4*4*128])
+    return h_pool31_flat
+
+  def fc_head(h_pool31_flat,keep_prob):
+    ###### Fully connected layer ####
     h_fc = tf.nn.relu(tf.matmul(h_pool31_flat, W_fc) + b_fc)
 
-    #dropout keep_prob = 0.5 in case of training and 1 otherwise
-    h_fc = tf.nn.dropout(h_fc, keep_prob)
+    #dropout keep_prob = 0.5 in case of training and 1 otherwise,
+    #None leaves dropout out of the graph (for the exported inference graph)
+    if keep_prob is not None:
+      h_fc = tf.nn.dropout(h_fc, keep_prob)
 
     ###### Output layer #########
     logits = tf.matmul(h_fc, W_out) + b_out
     return logits
 
+  def conv_nn(x,keep_prob):
+    return fc_head(conv_trunk(x),keep_prob)
+
   #Feed the inputs to the cnn
-  logits = conv_nn(train_data_node,keep_prob)
   eval_logits = conv_nn(eval_data,keep_prob)
 
   #Get the predictions
-  train_pred = tf.nn.softmax(logits)
   eval_prediction = tf.nn.softmax(eval_logits)
- 
-  # Compute the loss of the model
-  loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits,train_labels_node))
 
+  # Inference only graph for export: no dropout, named input and output
+  export_data = tf.placeholder(tf.uint8, shape=(None, IMAGE_SIZE, IMAGE_SIZE, NUM_CHANNELS),
+                               name=EXPORT_INPUT)
+  export_prediction = tf.nn.softmax(conv_nn(export_data, None), name=EXPORT_OUTPUT)
+ 
   #Regularization
   regularize = tf.nn.l2_loss(W_fc) + tf.nn.l2_loss(b_fc) + tf.nn.l2_loss(W_out) + tf.nn.l2_loss(b_out)
-  loss+= 0.01*regularize
 
-  #define an optimizer
-  optimizer = tf.train.AdamOptimizer(1e-4).minimize(loss)
+  #define an optimizer, the step counter is saved with the checkpoints
+  global_step = tf.Variable(0, trainable=False, name='global_step')
+  adam = tf.train.AdamOptimizer(1e-4)
+
+  # Data parallel towers: every tower is a replica of conv_nn on its share
+  # of the global batch, they all use the same weight variables. Their
+  # gradients are averaged and applied in one Adam update, with one tower
+  # this is the same as adam.minimize(loss)
+  tower_data = tf.split(0, FLAGS.num_towers, train_data_node)
+  tower_labels = tf.split(0, FLAGS.num_towers, train_labels_node)
+  tower_losses = []
+  tower_preds = []
+  tower_grads = []
+  for i in xrange(FLAGS.num_towers):
+    with tf.name_scope('tower_%d' % i):
+      logits = conv_nn(tower_data[i],keep_prob)
+      # Compute the loss of the model
+      tower_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits,tower_labels[i]))
+      tower_loss+= FLAGS.l2_weight*regularize
+      tower_losses.append(tower_loss)
+      tower_preds.append(tf.nn.softmax(logits))
+      tower_grads.append(adam.compute_gradients(tower_loss))
+  if FLAGS.num_towers == 1:
+    loss = tower_losses[0]
+    train_pred = tower_preds[0]
+    grads = tower_grads[0]
+  else:
+    loss = tf.add_n(tower_losses) / FLAGS.num_towers
+    train_pred = tf.concat(0, tower_preds)
+    grads = [(tf.add_n([tower[v][0] for tower in tower_grads]) / FLAGS.num_towers, var)
+             for v, (_, var) in enumerate(tower_grads[0])]
+  optimizer = adam.apply_gradients(grads, global_step=global_step)
+
+  # Best full validation error so far, saved with the checkpoints so that
+  # a resumed run keeps tracking the best model
+  best_val_error = tf.Variable(100.0, trainable=False, name='best_val_error')
+  new_best_val_error = tf.placeholder(tf.float32)
+  update_best_val_error = tf.assign(best_val_error, new_best_val_error)
+  # Training progress in examples, so a resumed run finds its epoch even if
+  # the global batch size (--num_towers) and thus the steps per epoch changed
+  examples_seen = tf.Variable(0, trainable=False, dtype=tf.int64, name='examples_seen')
+  new_examples_seen = tf.placeholder(tf.int64)
+  update_examples_seen = tf.assign(examples_seen, new_examples_seen)
+
+  # Created after the optimizer so the Adam slots and powers are saved as well
+  saver = tf.train.Saver(max_to_keep=FLAGS.keep_checkpoints)
+  best_saver = tf.train.Saver(max_to_keep=1)
+  if FLAGS.checkpoint_dir:
+    checkpoint_path = os.path.join(FLAGS.checkpoint_dir, 'model.ckpt')
+    best_checkpoint_path = os.path.join(FLAGS.checkpoint_dir, 'best', 'model.ckpt')
+
+  if FLAGS.train_head:
+    # Head only training on the h_pool31_flat features of a trained trunk
+    trunk_vars = [W_conv11, b_conv11, W_conv12, b_conv12, W_conv21, b_conv21,
+                  W_conv22, b_conv22, W_conv31, b_conv31, W_conv32, b_conv32]
+    head_vars = [W_fc, b_fc, W_out, b_out]
+    eval_features = conv_trunk(eval_data)
+    head_features = tf.placeholder(data_type(), shape=(None, 4*4*128))
+    head_labels = tf.placeholder(tf.int64, shape=(None,))
+    head_logits = fc_head(head_features,keep_prob)
+    head_prediction = tf.nn.softmax(head_logits)
+    head_loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(head_logits,head_labels))
+    head_loss+= FLAGS.l2_weight*regularize
+    head_optimizer = tf.train.AdamOptimizer(FLAGS.head_learning_rate).minimize(head_loss, var_list=head_vars)
+    trunk_saver = tf.train.Saver(trunk_vars)
+    model_saver = tf.train.Saver(trunk_vars + head_vars)
+
+
+  def run_benchmark(sess):
+    """Time training steps and evaluation batches on the fake data."""
+    train_feed = {train_data_node: train_data, train_labels_node: train_labels, keep_prob: 0.5}
+    eval_feed = {eval_data: validation_data, keep_prob: 1}
+    for fetches, feed_dict, name, batch_size in (([optimizer, loss], train_feed, 'train', global_batch_size),
+                                                 (eval_prediction, eval_feed, 'eval', EVAL_BATCH_SIZE)):
+      # Warm-up steps are not timed
+      for step in xrange(FLAGS.benchmark_warmup):
+        sess.run(fetches, feed_dict=feed_dict)
+      step_times = []
+      for step in xrange(FLAGS.benchmark_steps):
+        start_time = time.time()
+        sess.run(fetches, feed_dict=feed_dict)
+        step_times.append(time.time() - start_time)
+      print_throughput(name, step_times, batch_size)
+
+  def run_in_batches(node, input_node, data, sess):
+    """Run node for all of data in batches of EVAL_BATCH_SIZE and stack the results."""
+    size = data.shape[0]
+    results = numpy.ndarray(shape=(size,) + tuple(node.get_shape().as_list()[1:]), dtype=numpy.float32)
+    for begin in xrange(0, size, EVAL_BATCH_SIZE):
+      end = min(begin + EVAL_BATCH_SIZE, size)
+      results[begin:end] = sess.run(node,feed_dict={input_node: data[begin:end],keep_prob:1})
+    return results
+
+  def train_head(sess):
+    """Train only the fully connected head on the cached features of a trained trunk."""
+    checkpoint = FLAGS.trunk_checkpoint
+    if not checkpoint and FLAGS.checkpoint_dir:
+      checkpoint = (tf.train.latest_checkpoint(os.path.join(FLAGS.checkpoint_dir, 'best')) or
+                    tf.train.latest_checkpoint(FLAGS.checkpoint_dir))
+    if not checkpoint:
+      sys.exit('No trunk checkpoint found, train the whole network first or set --trunk_checkpoint')
+    trunk_saver.restore(sess, checkpoint)
+    print('Restored the conv trunk from %s' % checkpoint)
+
+    # The features of every split are computed once per trunk checkpoint and
+    # cached with their labels, which are used from then on: the examples
+    # are in a different order in runs that shuffle the splits again
+    splits = (('train', train_data), ('validation', validation_data), ('test', test_data))
+    names = [name for name, _ in splits]
+    cache_dir = feature_cache_dir(checkpoint, splits)
+    if os.path.exists(cache_dir):
+      features, labels = load_features(cache_dir, names)
+    else:
+      features = [run_in_batches(eval_features, eval_data, data, sess) for _, data in splits]
+      labels = [train_labels, validation_labels, test_labels]
+      save_features(cache_dir, names, features, labels)
+    train_features, validation_features, test_features = features
+    head_train_labels, head_validation_labels, head_test_labels = labels
+
+    # The head starts from its initial weights
+    for epoch in range(FLAGS.head_epochs):
+      epoch_loss = 0
+      perm = numpy.random.permutation(train_size)
+      for begin in xrange(0, train_size, BATCH_SIZE):
+        index = perm[begin:begin + BATCH_SIZE]
+        _,l = sess.run([head_optimizer,head_loss],feed_dict={head_features:train_features[index],
+                                                              head_labels:head_train_labels[index],keep_prob:0.5})
+        epoch_loss+=l
+      val_pred = run_in_batches(head_prediction, head_features, validation_features, sess)
+      print('Head epoch %d completed out of %d, epoch_loss: %.2f, validation error: %.2f %%' %
+            (epoch+1,FLAGS.head_epochs,epoch_loss,error_rate(val_pred, head_validation_labels)))
+    test_pred = run_in_batches(head_prediction, head_features, test_features, sess)
+    print('Test error: %.2f %%' % error_rate(test_pred, head_test_labels))
+    if FLAGS.checkpoint_dir:
+      head_checkpoint_path = os.path.join(FLAGS.checkpoint_dir, 'head', 'model.ckpt')
+      if not os.path.exists(os.path.dirname(head_checkpoint_path)):
+        os.makedirs(os.path.dirname(head_checkpoint_path))
+      model_saver.save(sess, head_checkpoint_path)
+      print('Saved trunk and head weights to %s' % head_checkpoint_path)
+
+  if FLAGS.benchmark:
+    with tf.Session(config=session_config()) as sess:
+      sess.run(tf.initialize_all_variables())
+      run_benchmark(sess)
+    return
 
+  if FLAGS.train_head:
+    with tf.Session(config=session_config()) as sess:
+      sess.run(tf.initialize_all_variables())
+      train_head(sess)
+      if FLAGS.export_graph:
+        export_frozen_graph(sess, FLAGS.export_graph)
+    return
 
   #Train
-  with tf.Session() as sess:
+  if FLAGS.resume and not FLAGS.checkpoint_dir:
+    sys.exit('--resume needs the --checkpoint_dir of the run to continue')
+  if FLAGS.checkpoint_dir:
+    # A fresh run would replace the best model of the run in there
+    if not FLAGS.resume and tf.train.latest_checkpoint(FLAGS.checkpoint_dir):
+      sys.exit('%s already holds checkpoints, use --resume to continue that run '
+               'or choose another --checkpoint_dir' % FLAGS.checkpoint_dir)
+    if not os.path.exists(os.path.dirname(best_checkpoint_path)):
+      os.makedirs(os.path.dirname(best_checkpoint_path))
+  # the batches are reshuffled every epoch and staged (and augmented) in the background.
+  # NOTE: a loop epoch of ceil(train_size / global_batch_size) steps uses up to
+  # global_batch_size-1 examples more than an epoch of train_set, so the loop
+  # epochs drift ahead of train_set.epochs_completed by that much per epoch
+  steps_per_epoch = (train_size + global_batch_size - 1) // global_batch_size
+  augment = None
+  if FLAGS.augment:
+    def augment(images, rng):
+      return input_data.augment_batch(images, rng, pad=FLAGS.augment_pad,
+                                      depth_jitter=FLAGS.depth_jitter)
+  batches = input_data.BatchPrefetcher(train_set, global_batch_size, augment=augment,
+                                       num_threads=FLAGS.augment_threads)
+  with tf.Session(config=session_config()) as sess:
       sess.run(tf.initialize_all_variables())
+      if FLAGS.resume:
+        checkpoint = tf.train.latest_checkpoint(FLAGS.checkpoint_dir)
+        if checkpoint:
+          # Restores the weights, the Adam state and the step and example counters
+          saver.restore(sess, checkpoint)
+          print('Resumed from %s' % checkpoint)
+        else:
+          print('No checkpoint in %s, training from scratch' % FLAGS.checkpoint_dir)
+      step, seen = sess.run([global_step, examples_seen])
+      if FLAGS.profile:
+        # Trace the steps of the profiling window, after some warm-up steps
+        run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        profile_begin = step + FLAGS.profile_start
+        profile_end = profile_begin + FLAGS.profile_steps
+        run_metadatas = []
+        python_times = []
       val_list = []
       train_list = []
-      for epoch in range(NUM_EPOCHS):
+      for epoch in range(seen // train_size, num_epochs):
           epoch_loss = 0
           epoch_train_error = 0
-          for b in range(int(train_size/BATCH_SIZE)):  # There will be some data left out at the end !! fix it
-              #getting the right batch for training
-              batch_begin = b*BATCH_SIZE
-              batch_end = batch_begin + BATCH_SIZE
-              x_train_batch = train_data[batch_begin:batch_end]
-              y_train_batch = train_labels[batch_begin:batch_end]
-
-              #get the loss and optimize
-              _,l =sess.run([optimizer,loss],feed_dict={train_data_node:x_train_batch, train_labels_node:y_train_batch,keep_prob:0.5})
-              pred = sess.run(train_pred,feed_dict={train_data_node:x_train_batch, keep_prob:1})
+          first_step = (seen % train_size) // global_batch_size
+          for b in range(first_step, steps_per_epoch):
+              profiling = FLAGS.profile and profile_begin <= step < profile_end
+              start_time = time.time()
+              #getting the next batch for training
+              x_train_batch, y_train_batch = batches.next_batch()
+              batch_time = time.time()
+              feed_dict = {train_data_node:x_train_batch, train_labels_node:y_train_batch,keep_prob:0.5}
+              feed_time = time.time()
+
+              #get the loss and predictions and optimize in one run,
+              #the running train error is thus measured with dropout
+              if profiling:
+                  run_metadata = tf.RunMetadata()
+                  _,l,pred =sess.run([optimizer,loss,train_pred],feed_dict=feed_dict,
+                                     options=run_options,run_metadata=run_metadata)
+                  run_metadatas.append(run_metadata)
+              else:
+                  _,l,pred =sess.run([optimizer,loss,train_pred],feed_dict=feed_dict)
+              run_time = time.time()
               epoch_loss+=l
               train_error = error_rate(pred, y_train_batch)
               epoch_train_error+= train_error
+              if profiling:
+                  python_times.append((batch_time-start_time, feed_time-batch_time,
+                                       run_time-feed_time, time.time()-run_time))
+                  if step == profile_end-1:
+                      write_profile(run_metadatas, python_times, FLAGS.profile_dir)
               if((b%EVAL_FREQUENCY) == 0):
-                  #Validatiion error should be on the whole validation data
-                  val_pred = eval_in_batches(validation_data,sess)
-                  val_error = error_rate(val_pred, validation_labels)
+                  #Validation error on the subsample
+                  val_pred = eval_in_batches(validation_subsample,sess)
+                  val_error = error_rate(val_pred, validation_subsample_labels)
                   val_list.append(val_error)
                   train_list.append(train_error)
                   print('Epoch: %d, step: %d, loss: %.2f, train error: %.2f %%, validation error: %.2f %%' %
                         (epoch+1,b,l,train_error,val_error))   
-          epoch_train_error = epoch_train_error/(b+1)
-          print('Epoch %d completed out of %d, epoch_loss: %.2f, epoch_train_error: %.2f %%' %
-                (epoch+1,NUM_EPOCHS,epoch_loss,epoch_train_error))
+              step += 1
+              seen = min(epoch*train_size + (b+1)*global_batch_size, (epoch+1)*train_size)
+              if FLAGS.checkpoint_dir and step % FLAGS.checkpoint_every == 0:
+                  sess.run(update_examples_seen, feed_dict={new_examples_seen: seen})
+                  saver.save(sess, checkpoint_path, global_step=step)
+          epoch_train_error = epoch_train_error/(steps_per_epoch-first_step)
+          #Validation error on the whole validation data
+          val_pred = eval_in_batches(validation_data,sess)
+          epoch_val_error = error_rate(val_pred, validation_labels)
+          print('Epoch %d completed out of %d, epoch_loss: %.2f, epoch_train_error: %.2f %%, validation error: %.2f %%' %
+                (epoch+1,num_epochs,epoch_loss,epoch_train_error,epoch_val_error))
+          if FLAGS.checkpoint_dir:
+              sess.run(update_examples_seen, feed_dict={new_examples_seen: seen})
+              if epoch_val_error < sess.run(best_val_error):
+                  sess.run(update_best_val_error, feed_dict={new_best_val_error: epoch_val_error})
+                  best_saver.save(sess, best_checkpoint_path, global_step=step)
+                  print('New best validation error, saved to %s' % os.path.dirname(best_checkpoint_path))
+              saver.save(sess, checkpoint_path, global_step=step)
+      batches.stop()
        
       test_pred = eval_in_batches(test_data,sess)
       test_error = error_rate(test_pred,test_labels)
       print('Test error: %.2f %%' % test_error)
       print('Confusion matrix:')
     #  NOTE: the following will require scikit-learn
-      print(confusion_matrix(test_labels, numpy.argmax(eval_in_batches(test_data, sess), 1)))
+      print(confusion_matrix(test_labels, numpy.argmax(test_pred, 1)))
+      if FLAGS.export_graph:
+        export_frozen_graph(sess, FLAGS.export_graph)
       plt.axis([0, 60, 0, 100])
       plt.xlabel("steps")
       plt.ylabel("Error(%)")
@@ -284,6 +671,177 @@ if __name__ == '__main__':
       help='Use rgb-d input data (4 channels).',
       action='store_true'
   )
+  parser.add_argument(
+      '--no_cache',
+      default=False,
+      help='Do not use the preprocessed dataset cache (see --cache_dir).',
+      action='store_true'
+  )
+  parser.add_argument(
+      '--cache_dir',
+      default='',
+      help='Writable directory for the preprocessed dataset cache (default: TRAIN_DIR/cache).'
+  )
+  parser.add_argument(
+      '--from_tar',
+      default=False,
+      help='Stream the images out of the downloaded archives instead of extracting them.',
+      action='store_true'
+  )
+  parser.add_argument(
+      '--augment',
+      default=False,
+      action='store_true',
+      help='Randomly crop, flip and depth jitter the training batches.'
+  )
+  parser.add_argument(
+      '--augment_pad',
+      type=int,
+      default=4,
+      help='Maximum shift in pixels of the random crops.'
+  )
+  parser.add_argument(
+      '--depth_jitter',
+      type=int,
+      default=8,
+      help='Maximum random shift of the quantized depth channel (RGB-D only).'
+  )
+  parser.add_argument(
+      '--augment_threads',
+      type=int,
+      default=2,
+      help='Number of threads preparing the training batches.'
+  )
+  parser.add_argument(
+      '--val_subsample',
+      type=int,
+      default=VAL_SUBSAMPLE,
+      help='Number of validation examples for the evaluations every EVAL_FREQUENCY steps '
+           '(0 for all of them).'
+  )
+  parser.add_argument(
+      '--num_towers',
+      type=int,
+      default=1,
+      help='Number of data parallel towers, each takes BATCH_SIZE examples of a step.'
+  )
+  parser.add_argument(
+      '--intra_op_threads',
+      type=int,
+      default=0,
+      help='Threads used inside a single op such as a convolution (0: TensorFlow default).'
+  )
+  parser.add_argument(
+      '--inter_op_threads',
+      type=int,
+      default=0,
+      help='Threads used to run independent ops in parallel (0: TensorFlow default).'
+  )
+  parser.add_argument(
+      '--benchmark',
+      default=False,
+      action='store_true',
+      help='Measure train and eval throughput on fake data instead of training.'
+  )
+  parser.add_argument(
+      '--benchmark_steps',
+      type=int,
+      default=100,
+      help='Number of timed steps per benchmark.'
+  )
+  parser.add_argument(
+      '--benchmark_warmup',
+      type=int,
+      default=10,
+      help='Number of untimed steps before each benchmark.'
+  )
+  parser.add_argument(
+      '--export_graph',
+      default='',
+      help='Write the trained model as a frozen inference graph to this file.'
+  )
+  parser.add_argument(
+      '--checkpoint_dir',
+      default='',
+      help='Directory for the training checkpoints, the best model is kept in its best/ '
+           'subdirectory (default: no checkpoints).'
+  )
+  parser.add_argument(
+      '--checkpoint_every',
+      type=int,
+      default=500,
+      help='Number of steps between checkpoints, one is also written after every epoch.'
+  )
+  parser.add_argument(
+      '--keep_checkpoints',
+      type=int,
+      default=5,
+      help='Number of most recent checkpoints to keep.'
+  )
+  parser.add_argument(
+      '--resume',
+      default=False,
+      action='store_true',
+      help='Continue training from the latest checkpoint in --checkpoint_dir.'
+  )
+  parser.add_argument(
+      '--profile',
+      default=False,
+      action='store_true',
+      help='Trace a window of training steps and print per-op and Python-side timings.'
+  )
+  parser.add_argument(
+      '--profile_start',
+      type=int,
+      default=20,
+      help='Number of training steps before the profiling window.'
+  )
+  parser.add_argument(
+      '--profile_steps',
+      type=int,
+      default=5,
+      help='Number of traced training steps.'
+  )
+  parser.add_argument(
+      '--profile_dir',
+      default='profile',
+      help='Directory for the Chrome-trace timelines (open them in chrome://tracing).'
+  )
+  parser.add_argument(
+      '--l2_weight',
+      type=float,
+      default=0.01,
+      help='Weight of the L2 regularization of the fully connected head.'
+  )
+  parser.add_argument(
+      '--train_head',
+      default=False,
+      action='store_true',
+      help='Train only the fully connected head on cached features of a trained conv trunk.'
+  )
+  parser.add_argument(
+      '--trunk_checkpoint',
+      default='',
+      help='Checkpoint of the conv trunk for --train_head (default: the best, else the latest '
+           'checkpoint in --checkpoint_dir).'
+  )
+  parser.add_argument(
+      '--feature_cache',
+      default='feature_cache',
+      help='Directory for the cached trunk features of --train_head.'
+  )
+  parser.add_argument(
+      '--head_epochs',
+      type=int,
+      default=50,
+      help='Number of epochs of head only training.'
+  )
+  parser.add_argument(
+      '--head_learning_rate',
+      type=float,
+      default=1e-4,
+      help='Adam learning rate of head only training.'
+  )
   parser.add_argument(
       '--self_test',
       default=False,
@@ -19,20 +19,36 @@ from __future__ import division
 from __future__ import print_function
 
 import tarfile
+import io
 import os
 import scipy.misc
-import glob
 import re
+import ctypes
+import multiprocessing
+import hashlib
+import shutil
+import json
+import collections
 
 import numpy
 import random
+import threading
+from six.moves import queue
 from six.moves import urllib
 from six.moves import xrange  # pylint: disable=redefined-builtin
 
 SOURCE_URL = 'http://www2.informatik.uni-freiburg.de/~eitel/deep_learning_course/rgbd_10/data/'
 IMAGE_SIZE = 32
-
-def maybe_download(filename, work_directory):
+# Number of images a worker process decodes per task.
+DECODE_CHUNK_SIZE = 256
+# Version of the preprocessing, part of the dataset cache key.
+# Increase it whenever the preprocessing changes.
+CACHE_VERSION = 3
+SPLITS = ('train', 'validation', 'test')
+# <instance>_<video>_<frame>_crop.png
+CROP_PATTERN = re.compile(r'^(.+)_[^_]*_[^_]*_crop\.png$')
+
+def maybe_download(filename, work_directory, extract=True):
   """Download the data from the website, unless it's already here."""
   if not os.path.exists(work_directory):
     os.mkdir(work_directory)
@@ -42,7 +58,8 @@ def maybe_download(filename, work_directory):
     filepath, _ = urllib.request.urlretrieve(SOURCE_URL + filename, filepath)
     statinfo = os.stat(filepath)
     print('Successfully downloaded', SOURCE_URL+filename, 'to', filepath, statinfo.st_size, 'bytes.')
-    extract_tar(filename, work_directory)
+    if extract:
+      extract_tar(filename, work_directory)
   return filepath
 
 def pad_image(img):
@@ -57,51 +74,218 @@ def pad_image(img):
   img_canvas[offs_row:offs_row+int(imsz[0]), offs_col:offs_col+int(imsz[1])] = img
   return (img_canvas)
 
-def load_images(image_set, filepath, end):
+def pad_depth(depth):
+  """Pad a float depth map [rows, columns] to a square, centred like pad_image.
+
+  The border is 0 (no depth reading) and the depth stays float, there is
+  no round trip through a uint8 canvas.
+  """
+  mxdim = max(depth.shape)
+  offs_row = (mxdim - depth.shape[0]) // 2
+  offs_col = (mxdim - depth.shape[1]) // 2
+  canvas = numpy.zeros((mxdim, mxdim), dtype=numpy.float32)
+  canvas[offs_row:offs_row+depth.shape[0], offs_col:offs_col+depth.shape[1]] = depth
+  return canvas
+
+def resize_weights(size_in, size_out):
+  """Matrix [size_out, size_in] of a bilinear (triangle filter) resize along one axis.
+
+  Like PIL's bilinear resize, the filter is widened by the scale factor
+  when shrinking, so every input pixel contributes to the output.
+  """
+  scale = size_in / size_out
+  support = max(scale, 1.0)
+  centers = (numpy.arange(size_out) + 0.5) * scale
+  dist = numpy.abs(numpy.arange(size_in)[None, :] + 0.5 - centers[:, None]) / support
+  weights = numpy.maximum(1.0 - dist, 0.0)
+  weights /= numpy.sum(weights, axis=1, keepdims=True)
+  return weights.astype(numpy.float32)
+
+def resize_bilinear(images, rows, cols):
+  """Bilinear resize of a float batch [batch, in rows, in columns] to [batch, rows, cols].
+
+  The resize is separable, so the whole batch is resized by two batched
+  matrix products.
+  """
+  weights_row = resize_weights(images.shape[1], rows)
+  weights_col = resize_weights(images.shape[2], cols)
+  return numpy.matmul(numpy.matmul(weights_row, images), weights_col.T)
+
+def quantize_depth(depth):
+  """Quantize float depth maps [..., rows, columns] from [0, max(depth)] -> uint8 [0, 255], per map."""
+  depth_max = numpy.max(depth, axis=(-2, -1), keepdims=True)
+  depth = numpy.rint(depth * (255.0 / numpy.maximum(depth_max, 1e-6)))
+  return depth.astype(numpy.uint8)
+
+def read_depth(path):
+  return scipy.misc.imread(path, False, 'F').astype(numpy.float32)
+
+def load_rgb_image(path):
+  """Decode, pad and resize one RGB image to a uint8 [IMAGE_SIZE, IMAGE_SIZE, 3] array.
+
+  The conversion to [0.0, 1.0] happens in the graph (see convolutional.py).
+  """
+  img = scipy.misc.imread(path, False, 'RGB')
+  img = pad_image(img)
+  img = scipy.misc.imresize(img, (IMAGE_SIZE,IMAGE_SIZE,3), 'bilinear')
+  return img
+
+def load_depth_image(path):
+  """Decode, pad and resize one depth map to a uint8 [IMAGE_SIZE, IMAGE_SIZE] array.
+
+  The depth is quantized to [0, 255] like the colour channels.
+  """
+  depth = pad_depth(read_depth(path))
+  depth = resize_bilinear(depth[None], IMAGE_SIZE, IMAGE_SIZE)[0]
+  return quantize_depth(depth)
+
+def load_depth_images(paths):
+  """Decode, pad and resize many depth maps to a uint8 [len(paths), IMAGE_SIZE, IMAGE_SIZE] array.
+
+  The padded maps are grouped by size and every group is resized at once.
+  """
+  depths = [pad_depth(read_depth(path)) for path in paths]
+  groups = {}
+  for i in xrange(len(depths)):
+    groups.setdefault(depths[i].shape[0], []).append(i)
+  resized = numpy.empty((len(depths), IMAGE_SIZE, IMAGE_SIZE), dtype=numpy.float32)
+  for index in groups.values():
+    resized[index] = resize_bilinear(numpy.stack([depths[i] for i in index]), IMAGE_SIZE, IMAGE_SIZE)
+  return quantize_depth(resized)
+
+def load_rgbd_batch(paths):
+  """Decode many (rgb path, depth path) pairs to a uint8 [len(paths), IMAGE_SIZE, IMAGE_SIZE, 4] array.
+
+  The depth maps of the batch are resized together (see load_depth_images).
+  """
+  rgb = numpy.stack([load_rgb_image(path_rgb) for path_rgb, _ in paths])
+  depth = load_depth_images([path_depth for _, path_depth in paths])
+  return numpy.concatenate((rgb, depth[..., None]), axis=3)
+
+# Output array shared with the decoding worker processes.
+_shared_images = None
+
+def _init_decode_worker(shared, shape):
+  global _shared_images
+  _shared_images = numpy.frombuffer(shared, dtype=numpy.uint8).reshape(shape)
+
+def _decode_into(images, loader, batched, begin, paths):
+  if batched:
+    images[begin:begin + len(paths)] = loader(paths)
+  else:
+    for i in xrange(len(paths)):
+      images[begin + i] = loader(*paths[i])
+
+def _decode_chunk(args):
+  _decode_into(_shared_images, *args)
+
+def decode_images(loader, paths, channels, num_workers=None, batched=False):
+  """Decode images in parallel into one uint8 array.
+
+  Every entry of paths holds the arguments of loader for one image. If
+  batched, loader instead takes a list of such entries and returns all
+  their images at once; it is called with up to DECODE_CHUNK_SIZE entries.
+  The worker processes write their results directly into a shared memory
+  array, so no decoded image is pickled back to the parent.
+  """
+  shape = (len(paths), IMAGE_SIZE, IMAGE_SIZE, channels)
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  if num_workers <= 1 or len(paths) <= DECODE_CHUNK_SIZE:
+    images = numpy.empty(shape, dtype=numpy.uint8)
+    for begin in xrange(0, len(paths), DECODE_CHUNK_SIZE):
+      _decode_into(images, loader, batched, begin, paths[begin:begin + DECODE_CHUNK_SIZE])
+    return images
+
+  shared = multiprocessing.RawArray(ctypes.c_uint8, int(numpy.prod(shape)))
+  chunks = [(loader, batched, begin, paths[begin:begin + DECODE_CHUNK_SIZE])
+            for begin in xrange(0, len(paths), DECODE_CHUNK_SIZE)]
+  pool = multiprocessing.Pool(num_workers, _init_decode_worker, (shared, shape))
+  try:
+    pool.map(_decode_chunk, chunks)
+  finally:
+    pool.close()
+    pool.join()
+  return numpy.frombuffer(shared, dtype=numpy.uint8).reshape(shape)
+
+def load_images(image_set, filepath, end, num_workers=None):
   print('Loading rgb', len(image_set), 'images from', filepath)
-  images = numpy.empty((len(image_set), IMAGE_SIZE , IMAGE_SIZE , 3), dtype=numpy.float32)
-  for i in xrange(0,len(image_set)):
-    img = scipy.misc.imread(os.path.join(filepath, image_set[i]+end), False, 'RGB')
-    img = pad_image(img)
-    img = scipy.misc.imresize(img, (IMAGE_SIZE,IMAGE_SIZE,3), 'bilinear')
-    # Convert from [0, 255] -> [0.0, 1.0].
-    img = img.astype(numpy.float32)
-    img = numpy.multiply(img, 1.0 / 255.0)
-    images[i] = img
+  paths = [(os.path.join(filepath, image_set[i]+end),) for i in xrange(0,len(image_set))]
+  return decode_images(load_rgb_image, paths, 3, num_workers)
 
-  return images
-
-def load_rgbd_images(image_set, filepath_rgb, filepath_depth, end):
+def load_rgbd_images(image_set, filepath_rgb, filepath_depth, end, num_workers=None):
   print('Loading rgbd', len(image_set), 'images from', filepath_rgb, 'and', filepath_depth)
-  channels = 4 
-  images = numpy.empty((len(image_set), IMAGE_SIZE , IMAGE_SIZE , channels), dtype=numpy.float32)
+  paths = [(os.path.join(filepath_rgb, image_set[i]+end),
+            os.path.join(filepath_depth, image_set[i].replace("crop", "depthcrop")+end))
+           for i in xrange(0,len(image_set))]
+  return decode_images(load_rgbd_batch, paths, 4, num_workers, batched=True)
+
+def _decode_member(args):
+  loader, name, data = args
+  return name, loader(io.BytesIO(data))
+
+def _decode_members(chunk):
+  return [_decode_member(args) for args in chunk]
+
+def decode_tar_members(tar_path, loader, wanted, num_workers=None):
+  """Decode images straight out of a tar archive without extracting it.
+
+  The archive is read in one sequential pass. Every .png member whose
+  name (without directory and extension) passes wanted(name) is decoded
+  in memory by loader, in a process pool while the archive is being read.
+  The members are submitted in chunks of DECODE_CHUNK_SIZE with at most
+  two chunks per worker outstanding, so reading the archive never runs
+  far ahead of decoding and the raw png bytes do not pile up in memory.
+  Returns a dict from name to decoded image.
+  """
+  print('Streaming images from', tar_path)
+
+  def members():
+    tar = tarfile.open(tar_path, 'r|*')
+    try:
+      for member in tar:
+        if not member.isfile() or not member.name.endswith('.png'):
+          continue
+        name = os.path.basename(member.name)[:-len('.png')]
+        if wanted(name):
+          yield loader, name, tar.extractfile(member).read()
+    finally:
+      tar.close()
+
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  if num_workers <= 1:
+    return dict(_decode_member(args) for args in members())
+  images = {}
+  pending = collections.deque()
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    chunk = []
+    for args in members():
+      chunk.append(args)
+      if len(chunk) == DECODE_CHUNK_SIZE:
+        if len(pending) >= 2 * num_workers:
+          images.update(pending.popleft().get())
+        pending.append(pool.apply_async(_decode_members, (chunk,)))
+        chunk = []
+    if chunk:
+      pending.append(pool.apply_async(_decode_members, (chunk,)))
+    while pending:
+      images.update(pending.popleft().get())
+    return images
+  finally:
+    pool.close()
+    pool.join()
+
+def stack_images(image_set, rgb_images, depth_images=None):
+  """Collect the decoded images of an image set into one uint8 array."""
+  channels = 3 if depth_images is None else 4
+  images = numpy.empty((len(image_set), IMAGE_SIZE, IMAGE_SIZE, channels), dtype=numpy.uint8)
   for i in xrange(0,len(image_set)):
-    # RGB image
-    img = scipy.misc.imread(os.path.join(filepath_rgb, image_set[i]+end), False, 'RGB')
-    img = pad_image(img)
-    img = scipy.misc.imresize(img, (IMAGE_SIZE,IMAGE_SIZE,3), 'bilinear')
-    # Convert from [0, 255] -> [0.0, 1.0].
-    img = img.astype(numpy.float32)
-    img = numpy.multiply(img, 1.0 / 255.0)
-
-    # Depth image
-    depth = scipy.misc.imread(os.path.join(filepath_depth, image_set[i].replace("crop", "depthcrop")+end), False, 'F')
-    depth = depth.reshape(depth.shape[0], depth.shape[1],1)
-    depth = pad_image(depth)
-    depth = scipy.misc.toimage(depth[:,:,0])
-    depth = scipy.misc.imresize(depth, (IMAGE_SIZE,IMAGE_SIZE), 'bilinear', 'F')
-    depth = numpy.asarray(depth)
-    # Convert from [0, max(depth)) -> [0.0, 1.0].
-    depth = depth.astype(numpy.float32)
-    depth = numpy.multiply(depth, 1.0/numpy.max(depth))
-
-    rgbd = numpy.zeros(  (IMAGE_SIZE,IMAGE_SIZE,channels), dtype=numpy.float32 )
-    rgbd[:,:,0] = img[:,:,0]
-    rgbd[:,:,1] = img[:,:,1]
-    rgbd[:,:,2] = img[:,:,2]
-    rgbd[:,:,3] = depth
-    images[i] = rgbd 
-  return images  
+    images[i, :, :, :3] = rgb_images[image_set[i]]
+    if depth_images is not None:
+      images[i, :, :, 3] = depth_images[image_set[i].replace("crop", "depthcrop")]
+  return images
 
 def load_labels(image_set, label_file):
   label_db = {}
@@ -123,8 +307,52 @@ def extract_tar(filename, train_dir):
   tar.extractall(path=train_dir)  
 
 
-def load_image_set_index(image_set, train_dir):
-  """Load the indexes listed in this dataset's image set file."""
+def index_image_files(filenames):
+  """Map every instance to the names of its crop images."""
+  image_index = {}
+  for filename in sorted(filenames):
+    match = CROP_PATTERN.match(filename)
+    if match:
+      image_index.setdefault(match.group(1), []).append(filename[:-len('.png')])
+  return image_index
+
+def build_image_index(train_dir):
+  """List the image directory once and map every instance to its crop images."""
+  return index_image_files(os.listdir(os.path.join(train_dir, 'images')))
+
+def load_image_index(train_dir, use_cache=True, cache_dir=None):
+  """Build the instance -> images index or load it from the cache in cache_dir.
+
+  The cached index is only used while the modification time of the
+  image directory is unchanged. Writing the cache is best effort, a
+  read-only cache_dir only means the index is rebuilt every time.
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(train_dir, 'cache')
+  mtime = os.path.getmtime(os.path.join(train_dir, 'images'))
+  cache_file = os.path.join(cache_dir, 'image_index.json')
+  if use_cache and os.path.exists(cache_file):
+    with open(cache_file) as f:
+      cache = json.load(f)
+    if cache['mtime'] == mtime:
+      return cache['index']
+  image_index = build_image_index(train_dir)
+  if use_cache:
+    tmp_file = '%s.tmp%d' % (cache_file, os.getpid())
+    try:
+      if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+      with open(tmp_file, 'w') as f:
+        json.dump({'mtime': mtime, 'index': image_index}, f)
+      os.rename(tmp_file, cache_file)
+    except (IOError, OSError) as e:
+      print('Could not save image index to %s (%s), continuing without it' % (cache_file, e))
+      if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+  return image_index
+
+def load_instance_index(image_set, train_dir):
+  """Load the instances listed in this dataset's image set file."""
   # Example path to image set file:
   # self._data_path + /ImageSets/val.txt
   image_set_file = os.path.join(train_dir, 'sets', 
@@ -133,19 +361,26 @@ def load_image_set_index(image_set, train_dir):
           'Path does not exist: {}'.format(image_set_file)
   with open(image_set_file) as f:
       instance_index = [x.strip() for x in f.readlines()]
+  return instance_index
+
+def load_image_set_index(image_set, train_dir, image_index=None):
+  """Load the indexes listed in this dataset's image set file.
+
+  image_index maps instances to their images, see build_image_index().
+  Pass it when loading several sets to list the image directory only once.
+  """
+  instance_index = load_instance_index(image_set, train_dir)
   print(image_set,'set:', instance_index)
-  image_index = []
-  counter = 0
+  if image_index is None:
+    image_index = build_image_index(train_dir)
+  image_set_index = []
   for index in instance_index:
-    search_result = glob.glob(train_dir+'/images/'+index+'_*_*_crop.png')
-    counter +=len(search_result)
-    for result in search_result:
-      ind = (result.split('/')[-1]).split('.')[:-1][0]
-      image_index.append(ind)
-  print('Number of datapoints', image_set, ':', len(image_index))
-  return image_index
+    image_set_index.extend(image_index.get(index, []))
+  print('Number of datapoints', image_set, ':', len(image_set_index))
+  return image_set_index
 
 class DataSet(object):
+  """Images as uint8 [num examples, rows, columns, channels] and their labels."""
 
   def __init__(self, images, labels, one_hot=False, rgbd=False):
 
@@ -168,6 +403,7 @@ class DataSet(object):
     self._labels = labels
     self._epochs_completed = 0
     self._index_in_epoch = 0
+    self._perm = None
 
   @property
   def images(self):
@@ -185,8 +421,169 @@ class DataSet(object):
   def epochs_completed(self):
     return self._epochs_completed
 
+  def next_batch(self, batch_size):
+    """Return the next `batch_size` examples from this data set.
+
+    The examples are reshuffled every epoch. The last batch of an epoch
+    is filled up with the first examples of the next one, so every example
+    is seen once per epoch and no data is left out. The examples of the
+    old epoch in that batch are moved to the end of the new permutation,
+    so the batch never holds an example twice (if batch_size <= num_examples).
+    """
+    if self._perm is None:
+      self._perm = numpy.random.permutation(self._num_examples)
+    start = self._index_in_epoch
+    self._index_in_epoch += batch_size
+    if self._index_in_epoch <= self._num_examples:
+      index = self._perm[start:self._index_in_epoch]
+    else:
+      # Finished epoch, take the rest and continue with a new permutation
+      rest = self._perm[start:]
+      self._epochs_completed += 1
+      perm = numpy.random.permutation(self._num_examples)
+      in_rest = numpy.zeros(self._num_examples, dtype=bool)
+      in_rest[rest] = True
+      self._perm = numpy.concatenate((perm[~in_rest[perm]], perm[in_rest[perm]]))
+      self._index_in_epoch = batch_size - rest.shape[0]
+      index = numpy.concatenate((rest, self._perm[:self._index_in_epoch]))
+    return self._images[index], self._labels[index]
+
+
+def augment_batch(images, rng, pad=4, flip=True, depth_jitter=0):
+  """Randomly crop, flip and depth jitter a uint8 batch [batch, rows, columns, channels].
+
+  Every image is cropped at a random offset from a copy padded by `pad`
+  pixels on each side (replicating the border), mirrored horizontally
+  with probability 0.5 if flip, and for RGB-D its depth channel is
+  shifted by a random integer in [-depth_jitter, depth_jitter]. The
+  padding is never materialized: crop and flip are one gather with
+  clipped indices into the original batch. Returns a new uint8 array.
+  """
+  batch_size, rows, cols = images.shape[:3]
+  offs_row = rng.randint(-pad, pad + 1, size=(batch_size, 1))
+  offs_col = rng.randint(-pad, pad + 1, size=(batch_size, 1))
+  row_index = numpy.clip(offs_row + numpy.arange(rows), 0, rows - 1)
+  col_index = numpy.arange(cols)
+  if flip:
+    col_index = numpy.where(rng.rand(batch_size, 1) < 0.5, cols - 1 - col_index, col_index)
+  col_index = numpy.clip(offs_col + col_index, 0, cols - 1)
+  batch_index = numpy.arange(batch_size)[:, None, None]
+  out = images[batch_index, row_index[:, :, None], col_index[:, None, :]]
+  if depth_jitter and images.shape[3] == 4:
+    shift = rng.randint(-depth_jitter, depth_jitter + 1, size=(batch_size, 1, 1))
+    out[..., 3] = numpy.clip(out[..., 3] + shift.astype(numpy.int16), 0, 255)
+  return out
+
+
+class BatchPrefetcher(object):
+  """Stage the next batches of a DataSet in background threads.
+
+  The threads keep up to `capacity` batches from data_set.next_batch() in
+  a queue, so gathering the next batch overlaps with the current step.
+  If augment is given, each batch is passed through augment(images, rng)
+  (see augment_batch) by the thread that fetched it, so augmented batches
+  are made just in time and no augmented copy of the data set is kept.
+  Every thread has its own numpy.random.RandomState.
+  """
+
+  def __init__(self, data_set, batch_size, capacity=8, augment=None, num_threads=1):
+    self._data_set = data_set
+    self._batch_size = batch_size
+    self._augment = augment
+    self._queue = queue.Queue(maxsize=capacity)
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._threads = []
+    for i in xrange(num_threads):
+      rng = numpy.random.RandomState(numpy.random.randint(2**31))
+      thread = threading.Thread(target=self._run, args=(rng,))
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _run(self, rng):
+    while not self._stop.is_set():
+      # DataSet.next_batch() is not thread safe
+      with self._lock:
+        images, labels = self._data_set.next_batch(self._batch_size)
+      if self._augment is not None:
+        images = self._augment(images, rng)
+      batch = images, labels
+      while not self._stop.is_set():
+        try:
+          self._queue.put(batch, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+
+  def next_batch(self):
+    return self._queue.get()
+
+  def stop(self):
+    self._stop.set()
+    for thread in self._threads:
+      thread.join()
+
+
+def dataset_cache_dir(train_dir, rgbd, cache_root):
+  """Directory of the preprocessed dataset cache in cache_root.
+
+  It is keyed by a hash of the image set files, IMAGE_SIZE, the rgb/rgbd
+  mode and CACHE_VERSION, so any change of these uses a new cache.
+  """
+  key = hashlib.sha1()
+  for split in SPLITS:
+    with open(os.path.join(train_dir, 'sets', split + '.txt'), 'rb') as f:
+      key.update(f.read())
+  key.update(('%d %d %s' % (CACHE_VERSION, IMAGE_SIZE, 'rgbd' if rgbd else 'rgb')).encode('ascii'))
+  return os.path.join(cache_root, key.hexdigest())
+
+def save_data_sets_cache(cache_dir, data_sets):
+  """Save images and labels of all splits as .npy files.
+
+  The files are written to a temporary directory of this process that is
+  renamed when complete, so an interrupted run never leaves a partial
+  cache behind. Saving is best effort: if the cache cannot be written
+  (e.g. read-only data directory) or another run saved it first, the
+  data sets are used uncached.
+  """
+  tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+  try:
+    if os.path.exists(tmp_dir):
+      shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+    for split in SPLITS:
+      data_set = getattr(data_sets, split)
+      numpy.save(os.path.join(tmp_dir, split + '_images.npy'), data_set.images)
+      numpy.save(os.path.join(tmp_dir, split + '_labels.npy'), data_set.labels)
+    os.rename(tmp_dir, cache_dir)
+    print('Saved dataset cache to', cache_dir)
+  except (IOError, OSError) as e:
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    if os.path.exists(cache_dir):
+      print('Dataset cache was saved by another run to', cache_dir)
+    else:
+      print('Could not save dataset cache to %s (%s), continuing without it' % (cache_dir, e))
+
+def load_data_sets_cache(cache_dir, data_sets, rgbd):
+  """Memory-map the cached images and labels of all splits."""
+  print('Loading dataset cache from', cache_dir)
+  for split in SPLITS:
+    images = numpy.load(os.path.join(cache_dir, split + '_images.npy'), mmap_mode='r')
+    labels = numpy.load(os.path.join(cache_dir, split + '_labels.npy'))
+    setattr(data_sets, split, DataSet(images, labels, False, rgbd))
+  return data_sets
+
+def read_data_sets(train_dir, rgbd, one_hot=False, num_workers=None, use_cache=True,
+                   from_tar=False, cache_dir=None):
+  """Load the train, validation and test sets.
 
-def read_data_sets(train_dir, rgbd, one_hot=False):
+  With from_tar the images are streamed out of the downloaded archives
+  instead of being extracted to disk and opened one by one. The caches
+  are kept in cache_dir (default: train_dir/cache).
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(train_dir, 'cache')
   class DataSets(object):
     pass
   data_sets = DataSets()
@@ -196,17 +593,38 @@ def read_data_sets(train_dir, rgbd, one_hot=False):
   LABELS = 'labels.tar.gz'
   IMAGE_SETS = 'sets.tar.gz'
 
-  # Dowload and extract data
-  local_file = maybe_download(IMAGES, train_dir)
+  # The image sets are needed for the cache key
   local_file = maybe_download(IMAGE_SETS, train_dir)
+  if use_cache:
+    data_sets_cache = dataset_cache_dir(train_dir, rgbd, cache_dir)
+    if os.path.exists(data_sets_cache):
+      return load_data_sets_cache(data_sets_cache, data_sets, rgbd)
+
+  # Dowload and extract data
+  local_file = maybe_download(IMAGES, train_dir, not from_tar)
   local_file = maybe_download(LABELS, train_dir)
   if (rgbd):
-    local_file = maybe_download(DEPTH_IMAGES, train_dir)
+    local_file = maybe_download(DEPTH_IMAGES, train_dir, not from_tar)
+
+  if from_tar:
+    # Decode all crops of the listed instances in one pass over the archive,
+    # their names then give the image index
+    instances = set()
+    for split in SPLITS:
+      instances.update(load_instance_index(split, train_dir))
+    def wanted(name):
+      match = CROP_PATTERN.match(name + '.png')
+      return match is not None and match.group(1) in instances
+    rgb_images = decode_tar_members(os.path.join(train_dir, IMAGES), load_rgb_image,
+                                    wanted, num_workers)
+    image_index = index_image_files([name + '.png' for name in rgb_images])
+  else:
+    image_index = load_image_index(train_dir, use_cache, cache_dir)
 
   # Load train/val/test sets 
-  train_set = load_image_set_index('train', train_dir)
-  validation_set = load_image_set_index('validation', train_dir)
-  test_set = load_image_set_index('test', train_dir)
+  train_set = load_image_set_index('train', train_dir, image_index)
+  validation_set = load_image_set_index('validation', train_dir, image_index)
+  test_set = load_image_set_index('test', train_dir, image_index)
   random.shuffle(train_set)
   random.shuffle(validation_set)
   random.shuffle(test_set)
@@ -216,15 +634,26 @@ def read_data_sets(train_dir, rgbd, one_hot=False):
   train_images = numpy.array([])  
   validation_images = numpy.array([])
   test_images = numpy.array([]) 
-  if (rgbd):
+  if from_tar:
+    depth_images = None
+    if (rgbd):
+      depth_names = set(name.replace("crop", "depthcrop") for name in rgb_images)
+      depth_images = decode_tar_members(os.path.join(train_dir, DEPTH_IMAGES),
+                                        load_depth_image, depth_names.__contains__,
+                                        num_workers)
+    train_images = stack_images(train_set, rgb_images, depth_images)
+    validation_images = stack_images(validation_set, rgb_images, depth_images)
+    test_images = stack_images(test_set, rgb_images, depth_images)
+    del rgb_images, depth_images
+  elif (rgbd):
     filepath_depth = os.path.join(train_dir, DEPTH_IMAGES.split('.')[-3])
-    train_images = load_rgbd_images(train_set, filepath, filepath_depth, '.png')
-    validation_images = load_rgbd_images(validation_set, filepath, filepath_depth, '.png')
-    test_images = load_rgbd_images(test_set, filepath, filepath_depth, '.png')
+    train_images = load_rgbd_images(train_set, filepath, filepath_depth, '.png', num_workers)
+    validation_images = load_rgbd_images(validation_set, filepath, filepath_depth, '.png', num_workers)
+    test_images = load_rgbd_images(test_set, filepath, filepath_depth, '.png', num_workers)
   else:
-    train_images = load_images(train_set, filepath, '.png')
-    validation_images = load_images(validation_set, filepath, '.png')
-    test_images = load_images(test_set, filepath, '.png')
+    train_images = load_images(train_set, filepath, '.png', num_workers)
+    validation_images = load_images(validation_set, filepath, '.png', num_workers)
+    test_images = load_images(test_set, filepath, '.png', num_workers)
 
   
   # Load labels
@@ -238,4 +667,6 @@ def read_data_sets(train_dir, rgbd, one_hot=False):
   data_sets.validation = DataSet(validation_images, validation_labels, False, rgbd)
   data_sets.test = DataSet(test_images, test_labels, False, rgbd)
   print('Finished dataset creation')
+  if use_cache:
+    save_data_sets_cache(data_sets_cache, data_sets)
   return data_sets
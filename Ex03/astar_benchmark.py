@@ -0,0 +1,94 @@
+import time
+import numpy as np; np.random.seed(0)
+# custom modules
+from utils     import Options
+from simulator import Simulator
+
+# Times Simulator.astar against a copy of the original dict based planner
+# and checks that both plan the same actions, on maps[0] and on larger
+# generated maps.
+
+def astar_reference(sim, bot_y, bot_x, tgt_y, tgt_x):
+    # the original planner: linear scan over the open_list dict for the min f score
+    def astar_act(bot_y, bot_x, act_ind):
+        bot_pos_new = np.ndarray(sim.state_dim, int)
+        bot_pos_new[0] = bot_y + sim.act_pos_ind[act_ind][0]
+        bot_pos_new[1] = bot_x + sim.act_pos_ind[act_ind][1]
+        if bot_pos_new[0] == tgt_y and bot_pos_new[1] == tgt_x: # reaching tgt
+            return (bot_pos_new[0], bot_pos_new[1]), True
+        elif sim.map[bot_pos_new[0]][bot_pos_new[1]] == 1: # collision
+            return (bot_y, bot_x), False
+        else:
+            return (bot_pos_new[0], bot_pos_new[1]), False
+
+    open_list = {} # (y, x): fVal
+    clsd_list = {} # (y, x): fVal
+    gVal_list = {} # (y, x): gVal
+    came_from = {} # (neighb_y, neighb_x): ((active_y, active_x), act_ind)
+    active_pose = (bot_y, bot_x)
+    gVal_list[active_pose] = 0
+    open_list[active_pose] = sim.get_h_val(active_pose, tgt_y, tgt_x)
+    while len(open_list) > 0:
+        min_fVal = None
+        for k, v in open_list.items():
+            if min_fVal is None or v < min_fVal:
+                min_pose  = k
+                min_fVal = v
+        active_pose = min_pose
+        clsd_list[active_pose] = open_list.pop(active_pose)
+        for act_ind in range(sim.act_num):
+            neighb_pose, terminal = astar_act(active_pose[0], active_pose[1], act_ind)
+            if terminal:
+                came_from[neighb_pose] = (active_pose, act_ind)
+                act_lst = []
+                tmp_pose = (tgt_y, tgt_x)
+                while tmp_pose != (bot_y, bot_x):
+                    act_lst.append(came_from[tmp_pose][1])
+                    tmp_pose = came_from[tmp_pose][0]
+                return act_lst
+            if neighb_pose != active_pose and not neighb_pose in clsd_list:
+                neighb_g = gVal_list[active_pose] + 1
+                neighb_f = neighb_g + sim.get_h_val(neighb_pose, tgt_y, tgt_x)
+                if not neighb_pose in open_list or open_list[neighb_pose] >= neighb_f:
+                    open_list[neighb_pose] = neighb_f
+                    gVal_list[neighb_pose] = neighb_g
+                    came_from[neighb_pose] = (active_pose, act_ind)
+    return None
+
+def generate_map(hei, wid, obs_density):
+    # random walls inside a border of walls of width 2 (like maps[0])
+    grid = (np.random.rand(hei, wid) < obs_density).astype(int)
+    grid[:2, :] = grid[-2:, :] = grid[:, :2] = grid[:, -2:] = 1
+    return grid
+
+def set_map(sim, grid):
+    sim.map     = grid
+    sim.map_hei = grid.shape[0]
+    sim.map_wid = grid.shape[1]
+
+def benchmark(sim, name, n_plans):
+    fre_pos = np.argwhere(sim.map == 0)
+    pairs = fre_pos[np.random.randint(fre_pos.shape[0], size=(n_plans, 2))]
+    time_ref = time_new = 0.
+    for (bot_y, bot_x), (tgt_y, tgt_x) in pairs:
+        start_time = time.time()
+        act_lst = astar_reference(sim, bot_y, bot_x, tgt_y, tgt_x)
+        time_ref += time.time() - start_time
+        start_time = time.time()
+        found = sim.astar(bot_y, bot_x, tgt_y, tgt_x)
+        time_new += time.time() - start_time
+        assert found == (act_lst is not None)
+        assert not found or sim.astar_act_lst == act_lst, (bot_y, bot_x, tgt_y, tgt_x)
+    print("%-16s %5d plans: reference %8.3f ms/plan, heap %8.3f ms/plan, speedup %6.1fx, same actions" %
+          (name, n_plans, 1000 * time_ref / n_plans, 1000 * time_new / n_plans, time_ref / time_new))
+
+# 0. initialization
+opt = Options()
+sim = Simulator(opt.map_ind, opt.cub_siz, opt.pob_siz, opt.act_num)
+
+# 1. benchmark on maps[0] and generated maps
+set_map(sim, sim.map)
+benchmark(sim, "maps[%d]" % opt.map_ind, 1000)
+for siz, n_plans in [(64, 100), (128, 20), (256, 5)]:
+    set_map(sim, generate_map(siz, siz, 0.2))
+    benchmark(sim, "random %dx%d" % (siz, siz), n_plans)
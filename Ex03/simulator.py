@@ -1,3 +1,4 @@
+import heapq
 import numpy as np
 from random import randrange
 # custom modules
@@ -88,73 +89,65 @@ class Simulator:
 
     def astar(self, bot_y, bot_x, tgt_y, tgt_x):
         # 0. setting up
+        # the open set is a binary heap of (fVal, order, y, x), order counts the
+        # first insertion of a pose, so ties in fVal are broken first in first out;
+        # entries of poses that got closed or a lower fVal since are skipped
         self.astar_terminal = False
-        open_count = 0
-        open_list = {} # (y, x): fVal
-        clsd_list = {} # (y, x): fVal
-        gVal_list = {} # (y, x): gVal
-        hVal_list = {} # (y, x): hVal
-        came_from = {} # (neighb_y, neighb_x): ((active_y, active_x), act_ind)
+        bot_y, bot_x, tgt_y, tgt_x = int(bot_y), int(bot_x), int(tgt_y), int(tgt_x)
+        act_pos = [(int(dy), int(dx)) for dy, dx in self.act_pos_ind[:self.act_num]]
+        walls  = self.map.tolist()
+        open_f = np.full((self.map_hei, self.map_wid), -1, int) # fVal while in open set, -1 otherwise
+        clsd   = np.zeros((self.map_hei, self.map_wid), bool)
+        gVal   = np.zeros((self.map_hei, self.map_wid), int)
+        order  = np.zeros((self.map_hei, self.map_wid), int)
+        act_from = np.full((self.map_hei, self.map_wid), -1, int) # action that reached a pose
 
-        # 1. push start node into open_list
-        active_pose = (bot_y, bot_x)
-        gVal_list[active_pose] = 0
-        hVal_list[active_pose] = self.get_h_val(active_pose, tgt_y, tgt_x)
-        open_list[active_pose] = gVal_list[active_pose] + hVal_list[active_pose]
-        open_count += 1
+        # 1. push start node into the open set
+        open_count = 1
+        open_f[bot_y, bot_x] = abs(bot_y - tgt_y) + abs(bot_x - tgt_x)
+        open_heap = [(int(open_f[bot_y, bot_x]), 0, bot_y, bot_x)]
 
         # 2. expand using A*
-        while open_count > 0:
-            # 0. sort open_list to pop the entry w/ min f score
-            min_fVal = None
-            for k, v in open_list.items():
-                if min_fVal is None or v < min_fVal:
-                    min_pose  = k
-                    min_fVal = v
-            active_pose = min_pose
-            clsd_list[active_pose] = open_list[active_pose] # add it in  clsd_list
-            open_list.pop(active_pose, "None")              # pop it out open_list
-            open_count -= 1
+        while open_heap:
+            # 0. pop the entry w/ min f score
+            fVal, _, active_y, active_x = heapq.heappop(open_heap)
+            if clsd[active_y, active_x] or fVal != open_f[active_y, active_x]:
+                continue
+            clsd[active_y, active_x] = True
+            open_f[active_y, active_x] = -1
+            neighb_g = int(gVal[active_y, active_x]) + 1
             # 1. iterate through all its possible successors
             for act_ind in range(self.act_num):
-                neighb_pose = self.astar_act(active_pose[0], active_pose[1], tgt_y, tgt_x, act_ind)
-                if self.astar_terminal: # have reached tgt, stop searching
-                    came_from[neighb_pose] = (active_pose, act_ind)
-                    self.astar_retrieve_actions(came_from, bot_y, bot_x, tgt_y, tgt_x)
+                neighb_y = active_y + act_pos[act_ind][0]
+                neighb_x = active_x + act_pos[act_ind][1]
+                if neighb_y == tgt_y and neighb_x == tgt_x: # have reached tgt, stop searching
+                    self.astar_terminal = True
+                    act_from[neighb_y, neighb_x] = act_ind
+                    self.astar_retrieve_actions(act_from, bot_y, bot_x, tgt_y, tgt_x)
                     return True
-                else:
-                    if neighb_pose != active_pose:      # if have actually moved
-                        if not neighb_pose in clsd_list:  # if not in clsd_list
-                            neighb_g = gVal_list[active_pose] + 1
-                            neighb_h = self.get_h_val(neighb_pose, tgt_y, tgt_x)
-                            neighb_f = neighb_g + neighb_h
-                            if not neighb_pose in open_list or open_list[neighb_pose] >= neighb_f:
-                                if not neighb_pose in open_list:
-                                    open_count += 1
-                                open_list[neighb_pose] = neighb_f
-                                gVal_list[neighb_pose] = neighb_g
-                                hVal_list[neighb_pose] = neighb_h
-                                came_from[neighb_pose] = (active_pose, act_ind)
+                # collisions and "o" stay on the (closed) active pose
+                if walls[neighb_y][neighb_x] == 1 or clsd[neighb_y, neighb_x]:
+                    continue
+                neighb_f = neighb_g + abs(neighb_y - tgt_y) + abs(neighb_x - tgt_x)
+                old_f = open_f[neighb_y, neighb_x]
+                if old_f == -1 or old_f >= neighb_f:
+                    if old_f == -1:
+                        order[neighb_y, neighb_x] = open_count
+                        open_count += 1
+                    open_f[neighb_y, neighb_x] = neighb_f
+                    gVal[neighb_y, neighb_x] = neighb_g
+                    act_from[neighb_y, neighb_x] = act_ind
+                    heapq.heappush(open_heap, (neighb_f, int(order[neighb_y, neighb_x]), neighb_y, neighb_x))
         return False
 
-    def astar_act(self, bot_y, bot_x, tgt_y, tgt_x, act_ind):
-        bot_pos_new = np.ndarray(self.state_dim, int)
-        bot_pos_new[0] = bot_y + self.act_pos_ind[act_ind][0]
-        bot_pos_new[1] = bot_x + self.act_pos_ind[act_ind][1]
-        if bot_pos_new[0] == tgt_y and bot_pos_new[1] == tgt_x: # reaching tgt
-            self.astar_terminal = True
-            return (bot_pos_new[0], bot_pos_new[1])
-        elif self.map[bot_pos_new[0]][bot_pos_new[1]] == 1: # collision
-            return (bot_y, bot_x)
-        else:
-            return (bot_pos_new[0], bot_pos_new[1])
-
-    def astar_retrieve_actions(self, came_from, bot_y, bot_x, tgt_y, tgt_x):
+    def astar_retrieve_actions(self, act_from, bot_y, bot_x, tgt_y, tgt_x):
         self.astar_act_lst = []
-        tmp_pose = (tgt_y, tgt_x)
-        while tmp_pose != (bot_y, bot_x):
-            self.astar_act_lst.append(came_from[tmp_pose][1])
-            tmp_pose = came_from[tmp_pose][0]
+        tmp_y, tmp_x = tgt_y, tgt_x
+        while (tmp_y, tmp_x) != (bot_y, bot_x):
+            act_ind = int(act_from[tmp_y, tmp_x])
+            self.astar_act_lst.append(act_ind)
+            tmp_y -= self.act_pos_ind[act_ind][0]
+            tmp_x -= self.act_pos_ind[act_ind][1]
 
     def act(self):
         bot_pos_new = self.obj_pos[self.bot_ind, :] + self.act_pos_ind[self.state_action, :]